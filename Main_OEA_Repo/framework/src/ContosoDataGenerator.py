@@ -2,6 +2,7 @@ import datetime
 import random
 import math
 import pandas as pd
+import numpy as np
 import DataGenUtil
 from faker import Faker
 
@@ -31,9 +32,11 @@ INCIDENTS = [('AA1', 'L1 Unexcused Absences'), ('ALA', 'L2 Abusive Lang w/Staff'
 
 class ContosoDataGenerator:
     def __init__(self, students_per_school=100, classes_in_student_schedule=6, students_per_section=25, student_teacher_ratio=9, include_optional_fields=True,
-                 fall_semester_start_date='2021-08-15', fall_semester_end_date='2021-12-15', spring_semester_start_date='2022-01-10', spring_semester_end_date='2022-05-10'):
+                 fall_semester_start_date='2021-08-15', fall_semester_end_date='2021-12-15', spring_semester_start_date='2022-01-10', spring_semester_end_date='2022-05-10',
+                 vectorized=False, faker_pool_size=None):
         # Set a seed value in Faker so it generates the same values every time it's run
-        self.faker = Faker('en_US')
+        if faker_pool_size: self.faker = DataGenUtil.FakerPool('en_US', faker_pool_size) # samples names, cities, etc from pools drawn once rather than calling faker for each value
+        else: self.faker = Faker('en_US')
         Faker.seed(1)
 
         self.students_per_school = students_per_school
@@ -45,6 +48,8 @@ class ContosoDataGenerator:
         self.fall_semester_end_date = fall_semester_end_date
         self.spring_semester_start_date = spring_semester_start_date
         self.spring_semester_end_date = spring_semester_end_date
+        # When True, the daily records are drawn with numpy for blocks of students at a time (same columns and distributions, different random sequence)
+        self.vectorized = vectorized
 
         self.teachers_per_school = math.ceil(self.students_per_school/self.student_teacher_ratio)
         self.section_id = 1
@@ -55,19 +60,31 @@ class ContosoDataGenerator:
         self.term_id = 1
         self.domain = '@Classrmtest86.org'
 
-    def generate_data(self, num_of_schools, writer):
-        schools = []
-        for n in range(num_of_schools):
-            school_data = self.create_school(n)
-            schools.append(school_data.pop('School'))
-            for key in school_data.keys(): 
-                data_str = DataGenUtil.list_of_dict_to_csv(school_data[key])
-                writer.write(f"contoso_sis/{key}.csv", data_str)
+    def generate_data(self, num_of_schools, writer, seed=None, processes=1):
+        """ Generates the data for the given number of schools. If a seed is given, each school gets its own seed derived from it (see DataGenUtil.generate_schools),
+            which allows the schools to be generated in parallel with processes > 1.
+        """
+        schools = DataGenUtil.generate_schools(self, num_of_schools, writer, seed, processes)
+        DataGenUtil.write_rows(schools, writer, 'contoso_sis/School.csv')
+        DataGenUtil.flush_writer(writer)
 
-        data_str = DataGenUtil.list_of_dict_to_csv(schools)
-        writer.write('contoso_sis/School.csv', data_str)        
+    def generate_school(self, n, writer):
+        """ Generates and writes out the data for one school, and returns the school's row for School.csv """
+        school_data = self.create_school(n, include_daily_records=False)
+        school = school_data.pop('School')
+        for key in school_data.keys(): 
+            DataGenUtil.write_rows(school_data[key], writer, f"contoso_sis/{key}.csv")
+        self.write_daily_records(n, school_data, writer)
+        return school
 
-    def create_school(self, school_id):
+    def set_id_ranges(self, school_index):
+        """ Sets the id counters to the values they have when the given school is reached in a serial run, so schools can be generated independently. """
+        self.student_id = school_index * self.students_per_school + 1
+        self.course_id = school_index * len(SUBJECTS) + 1
+        self.term_id = school_index * 2 + 1
+
+    def create_school(self, school_id, include_daily_records=True):
+        """ Creates the data for a school. If include_daily_records is False, the daily records are left out so they can be streamed with write_daily_records instead. """
         school_data = {}
         school_data['School'] = {
             'SchoolID': school_id,
@@ -76,7 +93,8 @@ class ContosoDataGenerator:
         school_data['Students'] = self.create_students(school_id)
         school_data['Courses'] = self.create_courses()
         school_data['Terms'] = self.create_terms()
-        school_data['Attendance'], school_data['ClassAttendance'], school_data['DailyIncidents'] = self.create_daily_records(school_id, school_data)
+        if include_daily_records:
+            school_data['Attendance'], school_data['ClassAttendance'], school_data['DailyIncidents'] = self.create_daily_records(school_id, school_data)
         return school_data
 
     def create_students(self, school_id):
@@ -140,17 +158,93 @@ class ContosoDataGenerator:
         return courses
 
     def create_daily_records(self, school_id, school_data):
+        records = {'Attendance': [], 'ClassAttendance': [], 'DailyIncidents': []}
+        for key, record in self.iter_daily_records(school_id, school_data):
+            records[key].append(record)
+        return (records['Attendance'], records['ClassAttendance'], records['DailyIncidents'])
+
+    def write_daily_records(self, school_id, school_data, writer):
+        """ Streams the daily records of the given school to the writer as they are generated, so memory use doesn't grow with the number of students or days. """
+        streams = {}
+        for key in ['Attendance', 'ClassAttendance', 'DailyIncidents']:
+            streams[key] = DataGenUtil.open_row_stream(writer, f"contoso_sis/{key}.csv")
+        for key, record in self.iter_daily_records(school_id, school_data):
+            streams[key].write_row(record)
+        for stream in streams.values():
+            stream.close()
+
+    def iter_daily_records(self, school_id, school_data):
+        """ Lazily generates the daily records (one per student per calendar day) as (entity_name, record) tuples,
+            where entity_name is one of 'Attendance', 'ClassAttendance' or 'DailyIncidents'.
+        """
         date_range = pd.date_range(datetime.datetime.strptime(self.fall_semester_start_date, "%Y-%m-%d"), datetime.datetime.strptime(self.spring_semester_end_date, "%Y-%m-%d"))
-        daily_attendance = []
-        class_attendance = []
-        incidents = []
+        if self.vectorized:
+            yield from self.iter_vectorized_daily_records(school_id, school_data, date_range)
+            return
         for student in school_data['Students']:
             for single_date in date_range:
-                daily_attendance.append(self.create_daily_attendance_record(school_id, student, single_date))
-                class_attendance.append(self.create_class_attendance_record(school_id, student, single_date, school_data['Courses']))
+                yield ('Attendance', self.create_daily_attendance_record(school_id, student, single_date))
+                yield ('ClassAttendance', self.create_class_attendance_record(school_id, student['ID'], single_date, school_data['Courses']))
                 if (random.randint(1, 100)) <= 10:  # 10% chance of an incident occurring
-                    incidents.append(self.create_incident_record(school_id, student['ID'], single_date))
-        return (daily_attendance, class_attendance, incidents)
+                    yield ('DailyIncidents', self.create_incident_record(school_id, student['ID'], single_date))
+
+    def iter_vectorized_daily_records(self, school_id, school_data, date_range, block_size=1000):
+        """ Vectorized version of iter_daily_records. Draws the attendance matrix (students x dates) for block_size students at a time with numpy
+            and formats the dates once per school, yielding records with the same columns, order and distributions as the per student-day implementation
+            (the values come from a different random sequence, so they differ from it for the same seed).
+        """
+        rng = DataGenUtil.create_numpy_rng()
+        dates = list(date_range.strftime("%Y-%m-%d"))
+        course_ids = [course['CourseID'] for course in school_data['Courses']]
+        attend_type_ids = [attend_type for attend_type, description in ATTENDANCE_TYPES]
+        students = school_data['Students']
+        for block_start in range(0, len(students), block_size):
+            block = students[block_start:block_start + block_size]
+            shape = (len(block), len(dates))
+            unexcused_all_day = DataGenUtil.weighted_choices(rng, [0, 1], (80, 20), shape)
+            excused_all_day = np.where(unexcused_all_day == 1, 0, DataGenUtil.weighted_choices(rng, [0, 1], (70, 30), shape)).tolist()
+            unexcused_all_day = unexcused_all_day.tolist()
+            tardies = DataGenUtil.weighted_choices(rng, [0, 1, 2, 3, 4, 5, 6], (50, 20, 10, 5, 5, 5, 5), shape).tolist()
+            unexcused_absent = DataGenUtil.weighted_choices(rng, [0, 1, 2, 3], (70, 10, 10, 10), shape).tolist()
+            excused_absent = DataGenUtil.weighted_choices(rng, [0, 1, 2, 3], (60, 20, 10, 10), shape).tolist()
+            class_course_ids = rng.choice(course_ids, size=shape).tolist()
+            class_attend_type_ids = rng.choice(attend_type_ids, size=shape).tolist()
+            has_incident = (rng.integers(1, 101, size=shape) <= 10).tolist()  # 10% chance of an incident occurring
+            incidents = rng.integers(len(INCIDENTS), size=shape).tolist()
+            involvements = rng.integers(len(INVOLVEMENTS), size=shape).tolist()
+            actions = rng.integers(len(ACTIONS), size=shape).tolist()
+
+            for i, student in enumerate(block):
+                for j, date_str in enumerate(dates):
+                    yield ('Attendance', {
+                        'SchoolID': school_id,
+                        'AttendanceDate': date_str,
+                        'StudentID': student['ID'],
+                        'NumofPossiblePeriods': 6,
+                        'NumofTardies': tardies[i][j],
+                        'NumofUnexcusedAbsent': unexcused_absent[i][j],
+                        'NumofExcusedAbsent': excused_absent[i][j],
+                        'UnexcusedAllDay': unexcused_all_day[i][j],
+                        'ExcusedAllDay': excused_all_day[i][j],
+                        'Cumulative GPA': student['CumulativeGPA']
+                    })
+                    yield ('ClassAttendance', {
+                        'SchoolID': school_id,
+                        'AttendanceDate': date_str,
+                        'StudentID': student['ID'],
+                        'Term': '1',
+                        'CourseID': class_course_ids[i][j],
+                        'AttendTypeID': class_attend_type_ids[i][j]
+                    })
+                    if has_incident[i][j]:
+                        yield ('DailyIncidents', {
+                            'StudentID': student['ID'],
+                            'SchoolID': school_id,
+                            'IncidentID': INCIDENTS[incidents[i][j]][0],
+                            'InvolvementID': INVOLVEMENTS[involvements[i][j]][0],
+                            'IncidentDate': date_str,
+                            'ActionID': ACTIONS[actions[i][j]][0]
+                        })
 
     def create_class_attendance_record(self, school_id, student_id, date_value, courses):
         # todo: fix term id to use the correct term id based on the date
@@ -1,30 +1,436 @@
 import os
+import io
+import time
+import collections
+import csv
 import json
+import random
+import hashlib
+import uuid
+import functools
+import multiprocessing
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Rows are buffered until the serialized csv reaches this size, then handed to the writer in one call.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
 
 def list_of_dict_to_csv(list_of_dict, includeHeaders = True):
-    csv_str = ''
+    lines = []
     if includeHeaders == True:
-        header = []
-        for column_name in list_of_dict[0].keys(): 
-            if not column_name.startswith('_'): header.append(column_name)
-        csv_str += ",".join(header) + "\n"
-
+        lines.append(",".join(get_column_names(list_of_dict[0])))
     for row in list_of_dict:
-        csv_str += obj_to_csv(row) + "\n"
-
-    return csv_str
+        lines.append(obj_to_csv(row))
+    lines.append('')
+    return "\n".join(lines)
 
 def obj_to_csv(obj):
-    csv = ''
-    for key in obj:
-        if not (key.startswith('_')): csv += str(obj[key]) + ','
-    return csv[:-1]
+    return ",".join([str(obj[key]) for key in obj if not key.startswith('_')])
+
+def get_column_names(obj):
+    """ Returns the keys of the given row dict that should be written out (keys starting with '_' are internal to the generators). """
+    return [key for key in obj if not key.startswith('_')]
+
+def open_row_stream(writer, path_and_filename, includeHeaders = True):
+    """ Returns a row stream for the given writer: the writer's own stream if it writes rows natively (eg, ParquetWriter), otherwise a CsvRowStream. """
+    if hasattr(writer, 'open_row_stream'): return writer.open_row_stream(path_and_filename, includeHeaders)
+    return CsvRowStream(writer, path_and_filename, includeHeaders)
+
+def write_rows(rows, writer, path_and_filename, includeHeaders = True):
+    """ Writes the given iterable of row dicts with the writer's row stream (see open_row_stream). Returns the number of rows written. """
+    stream = open_row_stream(writer, path_and_filename, includeHeaders)
+    stream.write_rows(rows)
+    stream.close()
+    return stream.row_count
+
+def write_rows_as_csv(rows, writer, path_and_filename, includeHeaders = True, chunk_size = DEFAULT_CHUNK_SIZE):
+    """ Streams the given iterable of row dicts as csv to the given writer (FileWriter or DataLakeWriter).
+        Returns the number of rows written.
+        Ex: write_rows_as_csv(school_data['Students'], writer, 'contoso_sis/Students.csv')
+    """
+    stream = CsvRowStream(writer, path_and_filename, includeHeaders, chunk_size)
+    stream.write_rows(rows)
+    stream.close()
+    return stream.row_count
+
+class CsvRowStream:
+    """ Serializes row dicts as csv (quoted per RFC 4180) and passes the output to a FileWriter or DataLakeWriter in chunks of about chunk_size characters,
+        so memory use stays constant no matter how many rows are written.
+        The columns are taken from the first row written; keys starting with '_' are skipped.
+    """
+    def __init__(self, writer, path_and_filename, includeHeaders = True, chunk_size = DEFAULT_CHUNK_SIZE):
+        self.writer = writer
+        self.path_and_filename = path_and_filename
+        self.includeHeaders = includeHeaders
+        self.chunk_size = chunk_size
+        self.columns = None
+        self.row_count = 0
+        self.written = False
+        self.buffer = io.StringIO()
+        self.csv_writer = csv.writer(self.buffer, lineterminator='\n')
+
+    def write_row(self, row):
+        if self.columns is None:
+            self.columns = get_column_names(row)
+            if self.includeHeaders: self.csv_writer.writerow(self.columns)
+        self.csv_writer.writerow([row[column] for column in self.columns])
+        self.row_count += 1
+        if self.buffer.tell() >= self.chunk_size: self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def flush(self):
+        data_str = self.buffer.getvalue()
+        if data_str:
+            self.writer.write(self.path_and_filename, data_str)
+            self.written = True
+            self.buffer.seek(0)
+            self.buffer.truncate(0)
+
+    def close(self):
+        self.flush()
+        # a stream with no rows still creates the (empty) file, as writing the csv text would
+        if not self.written:
+            self.writer.write(self.path_and_filename, '')
+            self.written = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def create_numpy_rng():
+    """ Returns a numpy random generator seeded from python's random module, so seeding random also makes the vectorized draws repeatable. """
+    return np.random.default_rng(random.getrandbits(64))
+
+def weighted_choices(rng, population, weights, size):
+    """ Vectorized counterpart of random.choices(population, weights)[0]: draws an array of the given size (int or shape tuple) in one call. """
+    p = np.asarray(weights, dtype=float)
+    return np.asarray(population)[rng.choice(len(population), size=size, p=p / p.sum())]
+
+class SectionSeatAllocator:
+    """ Hands out the available seats of a term's sections: each call to allocate takes one seat from each of the first n sections that still have seats.
+        Full sections are dropped from the front of the queue, so allocating n seats costs O(n) no matter how many sections are already full.
+        Ex: seats = SectionSeatAllocator(); seats.add_section('sec1', 25); section_ids = seats.allocate(6)
+    """
+    def __init__(self):
+        self.sections = collections.deque() # [section_id, remaining seats], in the order the sections were added
+
+    def add_section(self, section_id, seats):
+        if seats > 0: self.sections.append([section_id, seats])
+
+    def allocate(self, n):
+        """ Returns the ids of the (up to n) sections a seat was taken from, in section order. """
+        taken = []
+        while self.sections and len(taken) < n:
+            taken.append(self.sections.popleft())
+        for section in reversed(taken):
+            section[1] -= 1
+            if section[1] > 0: self.sections.appendleft(section)
+        return [section[0] for section in taken]
+
+    def available_seats(self):
+        return sum(section[1] for section in self.sections)
+
+# Formats tried, in order, for timestamp and date values that arrow can't parse itself (eg, '8/13/2020 10:09:43 AM'); the first format that parses
+# every value of a batch is used, so day first dates (eg, the '13/09/2019' attendance dates of M365DataGenerator) are told apart by their batch.
+TIMESTAMP_FORMATS = ['ISO8601', '%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y', '%d/%m/%Y']
+
+# Maps the data types used in OEA schemas (eg, ['Period', 'short', 'no-op']) to the name of the corresponding pyarrow type factory
+OEA_TO_ARROW_TYPES = {'string': 'string', 'integer': 'int32', 'short': 'int16', 'long': 'int64', 'double': 'float64', 'float': 'float32',
+                      'boolean': 'bool_', 'date': 'date32', 'timestamp': 'timestamp'}
+
+class ParquetWriter:
+    """ Writes the row batches of the generators as Parquet files, typed with the given OEA schemas, instead of csv text.
+        Rows written to 'contoso_sis/Attendance.csv' land in 'contoso_sis/Attendance.parquet', typed with schemas['Attendance'] if it exists
+        (otherwise the types are inferred from the first batch of rows). entity_names maps the paths whose schema has a different name than the file
+        (eg, M365DataGenerator.MODULE_ENTITY_NAMES maps 'contoso_sis/attendance.csv' to the ContosoSIS module's 'studentattendance').
+        Each path stays open across schools until close() is called.
+        The files are written to the local file system, unless an fs is given (eg, mssparkutils.fs, or LocalFs): they're then written to a local temp folder
+        and copied to the root_destination with fs.cp when the writer is closed, so the data can be landed in the data lake.
+        Requires pyarrow.
+        Ex: writer = ParquetWriter(oea.stage1np + '/generated', {**m365.schemas, **contoso_sis.schemas}, entity_names=M365DataGenerator.MODULE_ENTITY_NAMES, fs=mssparkutils.fs)
+    """
+    def __init__(self, root_destination=None, schemas=None, row_group_size=100000, compression='snappy', entity_names=None, fs=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("ParquetWriter requires pyarrow (pip install pyarrow)")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        if not root_destination: self.root_destination = ''
+        elif not root_destination.endswith('/'): self.root_destination = root_destination + '/'
+        else: self.root_destination = root_destination
+        self.schemas = schemas if schemas else {}
+        self.entity_names = entity_names if entity_names else {}
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.fs = fs
+        self.local_root = tempfile.mkdtemp() + '/' if fs else self.root_destination
+        self.writers = {} # keyed by the path of the parquet file, relative to the root_destination
+
+    def write(self, path_and_filename, data_str):
+        raise TypeError(f"ParquetWriter only accepts row batches (see DataGenUtil.write_rows), not csv or json text. Cannot write: {path_and_filename}")
+
+    def open_row_stream(self, path_and_filename, includeHeaders = True):
+        return ParquetRowStream(self, path_and_filename)
+
+    def write_batch(self, path_and_filename, rows):
+        """ Writes a batch of row dicts as a row group of the Parquet file for the given path. """
+        parquet_path = os.path.splitext(path_and_filename)[0] + '.parquet'
+        if parquet_path not in self.writers:
+            schema = self.get_arrow_schema(path_and_filename, rows[0])
+            local_path = self.local_root + parquet_path
+            if os.path.dirname(local_path) and not os.path.exists(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            self.writers[parquet_path] = self.pq.ParquetWriter(local_path, schema, compression=self.compression)
+        writer = self.writers[parquet_path]
+        arrays = [self.to_arrow_array([row.get(field.name) for row in rows], field.type) for field in writer.schema]
+        writer.write_table(self.pa.Table.from_arrays(arrays, schema=writer.schema))
+
+    def get_arrow_schema(self, path_and_filename, first_row):
+        entity_name = self.entity_names.get(path_and_filename, os.path.splitext(os.path.basename(path_and_filename))[0])
+        schema = self.schemas.get(entity_name)
+        if schema is None:
+            # fall back to a case insensitive match (eg, 'attendance' for the entity 'Attendance')
+            schema = next((value for key, value in self.schemas.items() if key.lower() == entity_name.lower()), None)
+        if schema is None:
+            columns = get_column_names(first_row)
+            return self.pa.Table.from_pylist([{column: first_row[column] for column in columns}]).schema
+        return self.pa.schema([(col_name, self.to_arrow_type(dtype)) for col_name, dtype, op in schema])
+
+    def to_arrow_type(self, dtype):
+        if dtype.lower() not in OEA_TO_ARROW_TYPES: raise ValueError(f"Unsupported data type in OEA schema: {dtype}")
+        type_name = OEA_TO_ARROW_TYPES[dtype.lower()]
+        if type_name == 'timestamp': return self.pa.timestamp('us')
+        return getattr(self.pa, type_name)()
+
+    def to_arrow_array(self, values, arrow_type):
+        try:
+            return self.pa.array(values, type=arrow_type)
+        except (self.pa.ArrowInvalid, self.pa.ArrowTypeError):
+            # values that don't map directly to the type (eg, '2021-08-15' for a timestamp, or '1' for a boolean) are converted from their string representation
+            strings = [None if value is None or value == '' else str(value) for value in values]
+            try:
+                return self.pa.array(strings, type=self.pa.string()).cast(arrow_type)
+            except self.pa.ArrowInvalid:
+                if not (self.pa.types.is_timestamp(arrow_type) or self.pa.types.is_date(arrow_type)): raise
+                return self.pa.Array.from_pandas(parse_timestamps(strings)).cast(arrow_type, safe=False)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        if self.fs:
+            for parquet_path in self.writers:
+                self.fs.cp('file:' + os.path.abspath(self.local_root + parquet_path), self.root_destination + parquet_path)
+            shutil.rmtree(self.local_root, ignore_errors=True)
+            self.local_root = tempfile.mkdtemp() + '/'
+        self.writers = {}
+
+def parse_timestamps(values):
+    """ Parses the given strings (or None) as a pandas series of timestamps, with the first of TIMESTAMP_FORMATS that parses all of them. """
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return pd.to_datetime(pd.Series(values, dtype=object), format=timestamp_format)
+        except (ValueError, TypeError):
+            continue
+    raise ValueError(f"Could not parse the values as timestamps with any of {TIMESTAMP_FORMATS}, eg: {[value for value in values if value][:3]}")
+
+class ParquetRowStream:
+    """ Row stream for a ParquetWriter (see open_row_stream). Rows are written out in row groups of the writer's row_group_size. """
+    def __init__(self, parquet_writer, path_and_filename):
+        self.parquet_writer = parquet_writer
+        self.path_and_filename = path_and_filename
+        self.row_count = 0
+        self.rows = []
+
+    def write_row(self, row):
+        self.rows.append(row)
+        self.row_count += 1
+        if len(self.rows) >= self.parquet_writer.row_group_size: self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def flush(self):
+        if self.rows:
+            self.parquet_writer.write_batch(self.path_and_filename, self.rows)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class FakerPool:
+    """ Drop-in replacement for a Faker instance that samples the values of the slow, high-volume faker methods (names, cities, timestamps...)
+        from pools drawn once per seed, instead of generating each value from scratch. uuid4, pyint and random_number are drawn directly from a seeded random.Random.
+        Each pool is drawn by a faker seeded from (seed, method and arguments), so the pools don't depend on the order in which they're first used,
+        and the sampling is deterministic for a given seed (see seed_instance). Any other faker method is passed through to the wrapped faker.
+        Ex: self.faker = FakerPool('en_US', pool_size=10000)
+    """
+    POOLED_METHODS = ['first_name', 'first_name_male', 'first_name_female', 'last_name', 'city', 'password', 'date_time_between', 'date_between',
+                      'street_name', 'postcode', 'phone_number', 'building_number', 'state_abbr', 'free_email', 'free_email_domain']
+
+    def __init__(self, locale='en_US', pool_size=10000, seed=1):
+        from faker import Faker
+        self.faker = Faker(locale)
+        self.pool_faker = Faker(locale)
+        self.pool_size = pool_size
+        self.seed = seed
+        self.pools = {}
+        self.random = random.Random()
+        self.seed_instance(seed)
+
+    def seed_instance(self, seed):
+        """ Reseeds the sampling (and the wrapped faker); the pools themselves are kept, as they only depend on the seed the FakerPool was created with. """
+        self.random.seed(seed)
+        self.faker.seed_instance(seed)
+
+    def sample(self, method_name, *args, **kwargs):
+        """ Returns a value of the given faker method (called with the given args) from its pool, drawing the pool first if needed. """
+        key = (method_name, args, tuple(sorted(kwargs.items())))
+        if key not in self.pools:
+            self.pool_faker.seed_instance(derive_seed(self.seed, repr(key)))
+            method = getattr(self.pool_faker, method_name)
+            self.pools[key] = [method(*args, **kwargs) for _ in range(self.pool_size)]
+        return self.pools[key][self.random.randrange(self.pool_size)]
+
+    def uuid4(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+    def pyint(self, min_value=0, max_value=9999, step=1):
+        return self.random.randrange(min_value, max_value + 1, step)
+
+    def random_number(self, digits=None, fix_len=False):
+        if digits is None: digits = self.random.randint(1, 9)
+        if fix_len: return self.random.randint(10 ** (digits - 1), 10 ** digits - 1)
+        return self.random.randint(0, 10 ** digits - 1)
+
+    def __getattr__(self, name):
+        # only called for attributes not defined on the FakerPool itself
+        if name.startswith('__') or 'faker' not in self.__dict__: raise AttributeError(name)
+        if name in FakerPool.POOLED_METHODS: return functools.partial(self.sample, name)
+        return getattr(self.faker, name)
+
+def derive_seed(base_seed, school_index):
+    """ Derives the seed for one school from the base seed, so that each school's data doesn't depend on the schools generated before it. """
+    return int(hashlib.sha256(f"{base_seed}:{school_index}".encode()).hexdigest()[:16], 16)
+
+def seed_school(generator, base_seed, school_index):
+    """ Prepares a generator to create the given school independently of the others: seeds python's random module and the generator's faker
+        with the school's derived seed, and sets the generator's id counters to the range reserved for that school.
+    """
+    seed = derive_seed(base_seed, school_index)
+    random.seed(seed)
+    generator.faker.seed_instance(seed)
+    generator.set_id_ranges(school_index)
+
+def generate_schools(generator, num_of_schools, writer, seed=None, processes=1):
+    """ Calls generator.generate_school(school_index, writer) for each school and returns the values it returns, in school order.
+        If a seed is given, each school is seeded with seed_school before it is generated.
+        If processes > 1, the schools are generated in a pool of worker processes (a seed is then required). Each worker writes a school's output (text and row batches)
+        to a BufferWriter, and the buffers are written to the given writer in school order, so the output is byte-identical to a serial run with the same seed.
+    """
+    results = []
+    if processes > 1:
+        if seed is None: raise ValueError("A seed is required when generating schools with more than one process.")
+        with multiprocessing.Pool(processes, initializer=_initialize_school_worker, initargs=(generator, seed)) as pool:
+            for school_writer, result in pool.imap(_generate_school_in_worker, range(num_of_schools)):
+                school_writer.write_to(writer)
+                results.append(result)
+    else:
+        for n in range(num_of_schools):
+            if seed is not None: seed_school(generator, seed, n)
+            results.append(generator.generate_school(n, writer))
+    return results
+
+def flush_writer(writer):
+    """ Writes out the data the writer still has buffered (eg, a DataLakeWriter's pending appends), if it buffers any, so a generator's output
+        is complete when generate_data returns, even if the writer is never closed. """
+    if hasattr(writer, 'flush'): writer.flush()
+
+_worker_generator = None
+_worker_seed = None
+
+def _initialize_school_worker(generator, seed):
+    global _worker_generator, _worker_seed
+    _worker_generator = generator
+    _worker_seed = seed
+
+def _generate_school_in_worker(school_index):
+    seed_school(_worker_generator, _worker_seed, school_index)
+    writer = BufferWriter()
+    result = _worker_generator.generate_school(school_index, writer)
+    return (writer, result)
+
+class RowBatch:
+    """ The rows written to a BufferWriter through one of its row streams. """
+    def __init__(self, includeHeaders = True):
+        self.includeHeaders = includeHeaders
+        self.rows = []
+
+class BufferRowStream:
+    """ Row stream for a BufferWriter (see open_row_stream): keeps the row dicts as they are, so they can be written out later with any writer's row stream. """
+    def __init__(self, batch):
+        self.batch = batch
+        self.row_count = 0
+
+    def write_row(self, row):
+        self.batch.rows.append(row)
+        self.row_count += 1
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def close(self):
+        pass
+
+class BufferWriter:
+    """ Writer that keeps everything written to it in memory, in order: text as is, and the rows written through its row streams as row batches.
+        Used to collect the output of a school generated in a worker process, which is then written to the destination writer with write_to
+        (so the rows reach a writer that takes rows natively, like ParquetWriter, as rows).
+    """
+    def __init__(self):
+        self.items = [] # (path_and_filename, text or RowBatch), in the order they were written
+
+    def write(self, path_and_filename, data_str):
+        self.items.append((path_and_filename, data_str))
+
+    def open_row_stream(self, path_and_filename, includeHeaders = True):
+        batch = RowBatch(includeHeaders)
+        self.items.append((path_and_filename, batch))
+        return BufferRowStream(batch)
+
+    def write_to(self, writer):
+        """ Writes everything that was written to this writer to the given writer, in the same order. """
+        for path_and_filename, item in self.items:
+            if isinstance(item, RowBatch): write_rows(item.rows, writer, path_and_filename, item.includeHeaders)
+            else: writer.write(path_and_filename, item)
+
+    def getvalues(self):
+        """ Returns a dict of path_and_filename -> everything written to that path (with the rows as csv), in the order the paths were first written to. """
+        chunks = {}
+        class TextWriter:
+            def write(self, path_and_filename, data_str):
+                chunks.setdefault(path_and_filename, []).append(data_str)
+        self.write_to(TextWriter())
+        return {path_and_filename: ''.join(path_chunks) for path_and_filename, path_chunks in chunks.items()}
 
 def list_of_dict_to_json(list_of_dict):
-    json_str = '['
-    for row in list_of_dict:
-        json_str += obj_to_json(row) + ",\n"
-    return json_str[:-2] + ']'
+    return '[' + ",\n".join([obj_to_json(row) for row in list_of_dict]) + ']'
 
 def obj_to_json(obj):
     json_dict = {}
@@ -32,18 +438,152 @@ def obj_to_json(obj):
         if not (key.startswith('_')): json_dict[key] = obj[key]
     return json.dumps(json_dict)
 
+class DataLakeWriter:
+    """ Appends data to files in the data lake. Writes are collected per path and appended in blocks of at least flush_size characters
+        (or when flush() or close() is called), instead of making one storage call per write. If more than max_buffered_size characters are
+        buffered across all paths, the largest buffer is appended right away.
+        Call close(), or use the writer in a with block, to append the data that is still buffered (the data generators' generate_data flushes the writer it's given when it's done).
+        fs is the file system api to use and defaults to mssparkutils.fs; any object with the same append(path, content, createFileIfNotExists) method
+        can be passed instead (eg, DataGenUtil.LocalFs to run against the local file system).
+        Note: this class is also defined in OEA.py (OEA.py is %run into notebooks, where DataGenUtil isn't available, and DataGenUtil has to run without pyspark),
+        so any change made here must be made to the copy in OEA.py too.
+    """
+    def __init__(self, root_destination, flush_size=4*1024*1024, max_buffered_size=64*1024*1024, fs=None):
+        if fs is None:
+            from notebookutils import mssparkutils
+            fs = mssparkutils.fs
+        self.root_destination = root_destination
+        self.flush_size = flush_size
+        self.max_buffered_size = max_buffered_size
+        self.fs = fs
+        self.buffers = {}
+        self.buffered_sizes = {}
+        self.buffered_size = 0
+        self.appended_paths = set()
+        self.append_calls = 0
+
+    def write(self, path_and_filename, data_str, format='csv'):
+        if path_and_filename not in self.buffers:
+            self.buffers[path_and_filename] = []
+            self.buffered_sizes[path_and_filename] = 0
+        self.buffers[path_and_filename].append(data_str)
+        self.buffered_sizes[path_and_filename] += len(data_str)
+        self.buffered_size += len(data_str)
+        if self.buffered_sizes[path_and_filename] >= self.flush_size:
+            self._append(path_and_filename)
+        elif self.buffered_size > self.max_buffered_size:
+            self._append(max(self.buffered_sizes, key=self.buffered_sizes.get))
+
+    def _append(self, path_and_filename):
+        data_str = ''.join(self.buffers[path_and_filename])
+        # empty writes are still appended once, so the file gets created (as it would be without buffering)
+        if data_str or path_and_filename not in self.appended_paths:
+            self.fs.append(f"{self.root_destination}/{path_and_filename}", data_str, True) # Set the last parameter as True to create the file if it does not exist
+            self.appended_paths.add(path_and_filename)
+            self.append_calls += 1
+        self.buffered_size -= self.buffered_sizes[path_and_filename]
+        self.buffers[path_and_filename] = []
+        self.buffered_sizes[path_and_filename] = 0
+
+    def flush(self):
+        for path_and_filename in self.buffers:
+            self._append(path_and_filename)
+
+    def close(self):
+        self.flush()
+        self.buffers = {}
+        self.buffered_sizes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class LocalFs:
+    """ Stand-in for the mssparkutils.fs methods used by DataLakeWriter and ParquetWriter, backed by the local file system. Useful for running and testing the writers outside of Synapse. """
+    def __init__(self):
+        self.append_calls = 0
+
+    def append(self, path, content, createFileIfNotExists=False):
+        if not os.path.exists(path):
+            if not createFileIfNotExists: raise FileNotFoundError(path)
+            if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+        with open(path, 'a') as f:
+            f.write(content)
+        self.append_calls += 1
+
+    def put(self, path, content, overwrite=False):
+        if os.path.exists(path) and not overwrite: raise FileExistsError(path)
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def cp(self, src, dest, recurse=False):
+        if src.startswith('file:'): src = src[len('file:'):]
+        if os.path.dirname(dest) and not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        if recurse and os.path.isdir(src): shutil.copytree(src, dest, dirs_exist_ok=True)
+        else: shutil.copy(src, dest)
+
 class FileWriter:
-    def __init__(self, root_destination=None):
+    """ Appends data to files under root_destination. Writes are buffered (buffer_size bytes per file) and at most max_open_files files are kept open;
+        when the limit is reached the least recently written file is closed (flushing its buffer) and reopened later if needed.
+        Call close(), or use the writer in a with block, to flush the data that is still buffered.
+        get_stats() reports the amount of data written and the sustained write throughput.
+        Note: this class is also defined in OEA.py; keep the two copies in sync.
+    """
+    def __init__(self, root_destination=None, buffer_size=1024*1024, max_open_files=64):
         if not root_destination: self.root_destination = ''
         elif not root_destination.endswith('/'): self.root_destination = root_destination + '/'
         else: self.root_destination = root_destination
-        self.writers = {}
+        self.buffer_size = buffer_size
+        self.max_open_files = max_open_files
+        self.writers = collections.OrderedDict()
+        self.chars_written = 0
+        self.files_opened = 0
+        self.write_seconds = 0.0
 
     def write(self, path_and_filename, data_str):
+        start_time = time.perf_counter()
         path_and_filename = self.root_destination + path_and_filename
-        if path_and_filename not in self.writers.keys():
-            if not os.path.exists(os.path.dirname(path_and_filename)):
+        if path_and_filename in self.writers:
+            self.writers.move_to_end(path_and_filename)
+        else:
+            if len(self.writers) >= self.max_open_files:
+                least_recently_used_path, least_recently_used_writer = self.writers.popitem(last=False)
+                least_recently_used_writer.close()
+            if os.path.dirname(path_and_filename) and not os.path.exists(os.path.dirname(path_and_filename)):
                 os.makedirs(os.path.dirname(path_and_filename))
-            self.writers[path_and_filename] = open(path_and_filename, 'a')
-        
-        self.writers[path_and_filename].write(data_str)    
\ No newline at end of file
+            self.writers[path_and_filename] = open(path_and_filename, 'a', buffering=self.buffer_size)
+            self.files_opened += 1
+
+        self.writers[path_and_filename].write(data_str)
+        self.chars_written += len(data_str)
+        self.write_seconds += time.perf_counter() - start_time
+
+    def flush(self):
+        start_time = time.perf_counter()
+        for writer in self.writers.values():
+            writer.flush()
+        self.write_seconds += time.perf_counter() - start_time
+
+    def close(self):
+        start_time = time.perf_counter()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = collections.OrderedDict()
+        self.write_seconds += time.perf_counter() - start_time
+
+    def get_stats(self):
+        """ Returns the number of characters written, the number of times a file was opened, the time spent writing (including flushes) and the resulting throughput in MB/s. """
+        mb_per_second = self.chars_written / (1024 * 1024) / self.write_seconds if self.write_seconds else 0.0
+        return {'chars_written': self.chars_written, 'files_opened': self.files_opened, 'write_seconds': self.write_seconds, 'mb_per_second': mb_per_second}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -14,9 +14,10 @@ SUBJECT_NAMES = [('Math','Algebra'), ('Math','Geometry'), ('Language','English')
 
 
 class EdFiDataGenerator:
-    def __init__(self,number_students_per_school=100, include_optional_fields=True, school_year='2021', credit_conversion_factor = 2.0, number_of_grades_per_school = 5, is_current_school_year = True, graduation_plans_per_school = 10):
+    def __init__(self,number_students_per_school=100, include_optional_fields=True, school_year='2021', credit_conversion_factor = 2.0, number_of_grades_per_school = 5, is_current_school_year = True, graduation_plans_per_school = 10, faker_pool_size=None):
         # Set a seed value in Faker so it generates same values every run.
-        self.faker = Faker('en_US')
+        if faker_pool_size: self.faker = FakerPool('en_US', faker_pool_size) # samples names, cities, etc from pools drawn once rather than calling faker for each value
+        else: self.faker = Faker('en_US')
         Faker.seed(1)
 
         self.include_optional_fields = include_optional_fields
@@ -31,8 +32,11 @@ class EdFiDataGenerator:
     def get_descriptor_string(self, key, value):
         return "uri://ed-fi.org/{}#{}".format(key,value)
 
-    def generate_data(self, num_of_schools, writer):
-        edfi_data = [self.create_school() for _ in range(num_of_schools)]
+    def generate_data(self, num_of_schools, writer, seed=None, processes=1):
+        """ Generates the data for the given number of schools. If a seed is given, each school gets its own seed derived from it (see DataGenUtil.generate_schools),
+            which allows the schools to be generated in parallel with processes > 1.
+        """
+        edfi_data = generate_schools(self, num_of_schools, writer, seed, processes)
         edfi_data_formatted = self.format_edfi_data(edfi_data)
     
           
@@ -41,6 +45,15 @@ class EdFiDataGenerator:
         writer.write(f'EdFi/StudentSchoolAssociation.json',list_of_dict_to_json(edfi_data_formatted['StudentSchoolAssociations']))
         writer.write(f'EdFi/Course.json',list_of_dict_to_json(edfi_data_formatted['Courses']))
         writer.write(f'EdFi/Calendar.json',list_of_dict_to_json(edfi_data_formatted['Calendars']))
+        flush_writer(writer)
+
+    def generate_school(self, n, writer):
+        """ Creates one school; the EdFi entities of all schools are written out together by generate_data. """
+        return self.create_school()
+
+    def set_id_ranges(self, school_index):
+        # EdFi ids are generated by faker, so there are no id counters to set
+        pass
 
     def create_school(self):
         school_type = random.choice(SCHOOL_TYPES)
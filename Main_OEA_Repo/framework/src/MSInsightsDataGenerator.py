@@ -3,6 +3,8 @@ import os
 import shutil
 import random
 import math
+import datetime
+import DataGenUtil
 from faker import Faker
 
 SUBJECTS = ['Math - Algebra', 'Math - Geometry', 'English Language', 'History - World History',
@@ -16,9 +18,10 @@ class MSInsightsDataGenerator:
         format as defined in the roster.v0.3.2.cdm.json spec, and the activity format as defined in activity.v0.1.0.cdm.json
     """
     def __init__(self, activity_min_per_person=5, activity_max_per_person=20, students_per_school=100, classes_in_student_schedule=6, students_per_section=25, student_teacher_ratio=9, include_optional_fields=True,
-                 fall_semester_start_date='2021-08-15', fall_semester_end_date='2021-12-15', spring_semester_start_date='2022-01-10', spring_semester_end_date='2022-05-10'):
+                 fall_semester_start_date='2021-08-15', fall_semester_end_date='2021-12-15', spring_semester_start_date='2022-01-10', spring_semester_end_date='2022-05-10', faker_pool_size=None):
         # Set a seed value in Faker so it generates the same values every time it's run
-        self.faker = Faker('en_US')
+        if faker_pool_size: self.faker = DataGenUtil.FakerPool('en_US', faker_pool_size) # samples names, cities, etc from pools drawn once rather than calling faker for each value
+        else: self.faker = Faker('en_US')
         Faker.seed(1)
 
         self.activity_min_per_person = activity_min_per_person
@@ -33,6 +36,8 @@ class MSInsightsDataGenerator:
         self.spring_semester_start_date = spring_semester_start_date
         self.spring_semester_end_date = spring_semester_end_date
         self.school_year = '2021'
+        # Activity timestamps are drawn from the 60 days before this time (None means now)
+        self.activity_end_time = None
 
         self.teachers_per_school = math.ceil(self.students_per_school/self.student_teacher_ratio)
         self.section_id = 1
@@ -43,31 +48,49 @@ class MSInsightsDataGenerator:
         self.term_id = 1
         self.domain = '@Classrmtest86.org'
 
-    def generate_data(self, num_of_schools, writer):
-        schools = ''
-
-        for n in range(num_of_schools):
-            school_data = self.create_school(n)
-            m365_data = self.format_m365_data(school_data)
-            schools += m365_data.pop('Org')
-            for key in m365_data.keys(): 
-                writer.write(f"M365/roster/2021-07-12/{key}/part-00000-71379e08-1ce0-425f-9447-775b0dc134f1-example.csv", m365_data[key])
-            # Create empty files to reflect the empty files we currently get from MS Insights
-            empty_files_to_create = ['AadGroup', 'AadGroupMembership', 'AadUserPersonMapping', 'CourseGradeLevel', 'CourseSubject', ]
-            for entity in empty_files_to_create:
-                path_and_filename = f"M365/roster/2021-07-12/{entity}/part-00000-71379e08-1ce0-425f-9447-775b0dc134f1-example.csv"
-                writer.write(path_and_filename, '')
-
-
-
-            writer.write('contoso_sis/attendance.csv', school_data.pop('_attendance'))
-            writer.write('contoso_sis/section_marks.csv', school_data.pop('_section_marks'))
-            writer.write('contoso_sis/students.csv', self.list_of_dict_to_csv(school_data['_students']))
-
-            self.create_and_write_activity_data(school_data['_students'], 'M365/activity/2021-07-12/ApplicationUsage.Part001.csv', writer)
-            self.create_and_write_activity_data(school_data['_teachers'], 'M365/activity/2021-07-12/ApplicationUsage.Part002.csv', writer)
-
-        writer.write('m365/Org.csv', schools)
+    def generate_data(self, num_of_schools, writer, seed=None, processes=1):
+        """ Generates the data for the given number of schools. If a seed is given, each school gets its own seed derived from it (see DataGenUtil.generate_schools),
+            which allows the schools to be generated in parallel with processes > 1.
+        """
+        if seed is not None and self.activity_end_time is None:
+            # anchor the activity timestamps to the start of today so that every school (in any process) draws them from the same range
+            self.activity_end_time = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        schools = DataGenUtil.generate_schools(self, num_of_schools, writer, seed, processes)
+        DataGenUtil.write_rows(schools, writer, 'm365/Org.csv', includeHeaders=False)
+        DataGenUtil.flush_writer(writer)
+
+    def generate_school(self, n, writer):
+        """ Generates and writes out the data for one school, and returns the school's row for Org.csv """
+        school_data = self.create_school(n)
+        m365_data = self.format_m365_data(school_data)
+        org = m365_data.pop('Org')
+        for key in m365_data.keys(): 
+            DataGenUtil.write_rows(m365_data[key], writer, f"M365/roster/2021-07-12/{key}/part-00000-71379e08-1ce0-425f-9447-775b0dc134f1-example.csv", includeHeaders=False)
+        # Create empty files to reflect the empty files we currently get from MS Insights
+        empty_files_to_create = ['AadGroup', 'AadGroupMembership', 'AadUserPersonMapping', 'CourseGradeLevel', 'CourseSubject', ]
+        for entity in empty_files_to_create:
+            path_and_filename = f"M365/roster/2021-07-12/{entity}/part-00000-71379e08-1ce0-425f-9447-775b0dc134f1-example.csv"
+            DataGenUtil.write_rows([], writer, path_and_filename)
+
+        DataGenUtil.write_rows(school_data.pop('_attendance'), writer, 'contoso_sis/attendance.csv', includeHeaders=False)
+        DataGenUtil.write_rows(school_data.pop('_section_marks'), writer, 'contoso_sis/section_marks.csv', includeHeaders=False)
+        DataGenUtil.write_rows(school_data['_students'], writer, 'contoso_sis/students.csv')
+
+        for people, path_and_filename in [(school_data['_students'], 'M365/activity/2021-07-12/ApplicationUsage.Part001.csv'), (school_data['_teachers'], 'M365/activity/2021-07-12/ApplicationUsage.Part002.csv')]:
+            activity = DataGenUtil.open_row_stream(writer, path_and_filename, includeHeaders=False)
+            self.create_and_write_activity_data(people, activity)
+            activity.close()
+
+        return org
+
+    def set_id_ranges(self, school_index):
+        """ Sets the id counters to the values they have when the given school is reached in a serial run, so schools can be generated independently. """
+        sections_per_term = math.ceil(self.students_per_school * self.classes_in_student_schedule / self.students_per_section) + 1
+        self.student_id = school_index * self.students_per_school + 1
+        self.teacher_id = school_index * self.teachers_per_school + 1
+        self.course_id = school_index * len(SUBJECTS) + 1
+        self.term_id = school_index * 2 + 1
+        self.section_id = school_index * sections_per_term * 2 + 1
 
     def create_school(self, school_id):
         school_id = 'sch' + str(school_id)
@@ -131,41 +154,61 @@ class MSInsightsDataGenerator:
         datetime_str = "8/13/2020 10:09:43 AM"        
 
         m365_data = {}
-        m365_data['RefDefinition'] = REF_DEFINITION_CSV
-        #m365_data['Calendar'] = self.obj_to_csv(school['_calendar']) + "\n"
-        m365_data['Org'] = f"edp_{school['SIS ID']},{school['Name']},{school['School Number']},{school['SIS ID']},{datetime_str},{datetime_str},True,edp_{parent_org_id},{ref_org_type_school},{source_system_id}\n"
+        m365_data['RefDefinition'] = get_ref_definition_rows()
+        #m365_data['Calendar'] = [school['_calendar']]
+        m365_data['Org'] = {'Id': f"edp_{school['SIS ID']}", 'Name': school['Name'], 'Identifier': school['School Number'], 'ExternalId': school['SIS ID'], 'CreateDate': datetime_str,
+                            'LastModifiedDate': datetime_str, 'IsActive': 'True', 'ParentOrgId': f"edp_{parent_org_id}", 'RefOrgTypeId': ref_org_type_school, 'SourceSystemId': source_system_id}
         m365_data['StudentSectionMembership'] = school['_student_section_membership']
         m365_data['StaffSectionMembership'] = school['_staff_section_membership']
 
-        m365_data['Person'] = ''
-        m365_data['StudentOrgAffiliation'] = ''
-        m365_data['StaffOrgAffiliation'] = ''
-        m365_data['PersonIdentifier'] = ''
-        m365_data['Section'] = ''
-        m365_data['Session'] = ''
-        m365_data['Course'] = ''
+        m365_data['Person'] = []
+        m365_data['StudentOrgAffiliation'] = []
+        m365_data['StaffOrgAffiliation'] = []
+        m365_data['PersonIdentifier'] = []
+        m365_data['Section'] = []
+        m365_data['Session'] = []
+        m365_data['Course'] = []
 
         for student in school['_students']:
-            m365_data['StudentOrgAffiliation'] += f"edp_oa_{student['SIS ID']},True,,,oa_{student['SIS ID']},{datetime_str},{datetime_str},True,edp_{school['SIS ID']},edp_{student['SIS ID']},{self.get_grade_ref(student['Grade'])},{ref_student_org_role},{ref_enrollment_status}\n"
-            m365_data['Person'] += f"edp_{student['SIS ID']},{student['First Name']},{student['Middle Name']},{student['Last Name']},,,True,{student['SIS ID']},{datetime_str},{datetime_str},True,{source_system_id}\n"
-            m365_data['PersonIdentifier'] += f"edp_pi1_{student['SIS ID']},{student['_upn']},,{ref_upn_id},pi1_{student['SIS ID']},{datetime_str},{datetime_str},True,edp_{student['SIS ID']},{source_system_id}\n"
-            m365_data['PersonIdentifier'] += f"edp_pi2_{student['SIS ID']},{student['_aad']},,{ref_aad_id},pi2_{student['SIS ID']},{datetime_str},{datetime_str},True,edp_{student['SIS ID']},{source_system_id}\n"
+            m365_data['StudentOrgAffiliation'].append({'Id': f"edp_oa_{student['SIS ID']}", 'IsPrimary': 'True', 'EntryDate': '', 'ExitDate': '', 'ExternalId': f"oa_{student['SIS ID']}",
+                                                       'CreateDate': datetime_str, 'LastModifiedDate': datetime_str, 'IsActive': 'True', 'OrgId': f"edp_{school['SIS ID']}",
+                                                       'PersonId': f"edp_{student['SIS ID']}", 'RefGradeLevelId': self.get_grade_ref(student['Grade']),
+                                                       'RefStudentOrgRoleId': ref_student_org_role, 'RefEnrollmentStatusId': ref_enrollment_status})
+            m365_data['Person'].append(self.create_person_row(student, datetime_str, source_system_id))
+            m365_data['PersonIdentifier'] += self.create_person_identifier_rows(student, ref_upn_id, ref_aad_id, datetime_str, source_system_id)
         for teacher in school['_teachers']:
-            m365_data['StaffOrgAffiliation'] += f"edp_oa_{teacher['SIS ID']},True,,,oa_{teacher['SIS ID']},{datetime_str},{datetime_str},True,edp_{school['SIS ID']},edp_{teacher['SIS ID']},,{ref_staff_org_role}\n"
-            m365_data['Person'] += f"edp_{teacher['SIS ID']},{teacher['First Name']},{teacher['Middle Name']},{teacher['Last Name']},,,True,{teacher['SIS ID']},{datetime_str},{datetime_str},True,{source_system_id}\n"
-            m365_data['PersonIdentifier'] += f"edp_pi1_{teacher['SIS ID']},{teacher['_upn']},,{ref_upn_id},pi1_{teacher['SIS ID']},{datetime_str},{datetime_str},True,edp_{teacher['SIS ID']},{source_system_id}\n"
-            m365_data['PersonIdentifier'] += f"edp_pi2_{teacher['SIS ID']},{teacher['_aad']},,{ref_aad_id},pi2_{teacher['SIS ID']},{datetime_str},{datetime_str},True,edp_{teacher['SIS ID']},{source_system_id}\n"
+            m365_data['StaffOrgAffiliation'].append({'Id': f"edp_oa_{teacher['SIS ID']}", 'IsPrimary': 'True', 'EntryDate': '', 'ExitDate': '', 'ExternalId': f"oa_{teacher['SIS ID']}",
+                                                     'CreateDate': datetime_str, 'LastModifiedDate': datetime_str, 'IsActive': 'True', 'OrgId': f"edp_{school['SIS ID']}",
+                                                     'PersonId': f"edp_{teacher['SIS ID']}", 'RefStaffOrgRoleId': ref_staff_org_role})
+            m365_data['Person'].append(self.create_person_row(teacher, datetime_str, source_system_id))
+            m365_data['PersonIdentifier'] += self.create_person_identifier_rows(teacher, ref_upn_id, ref_aad_id, datetime_str, source_system_id)
         for term in school['_terms']:
         # todo: need to convert the term startdate and enddate to be the format that is expected to be coming from EDP (rather than the format used for sds)
-            m365_data['Session'] += f"edp_{term['Term SIS ID']},{term['Term Name']},{term['Term StartDate']},{term['Term EndDate']},{term['Term SIS ID']},8/13/2020 10:36:44 AM,8/15/2020 11:36:00 PM,True,{term['_calendar_id']},,{ref_session_type}\n"
+            m365_data['Session'].append({'Id': f"edp_{term['Term SIS ID']}", 'Name': term['Term Name'], 'BeginDate': term['Term StartDate'], 'EndDate': term['Term EndDate'],
+                                         'ExternalId': term['Term SIS ID'], 'CreateDate': '8/13/2020 10:36:44 AM', 'LastModifiedDate': '8/15/2020 11:36:00 PM', 'IsActive': 'True',
+                                         'CalendarId': term['_calendar_id'], 'ParentSessionId': '', 'RefSessionTypeId': ref_session_type})
         for section in term['_sections']:
-            m365_data['Section'] += f"edp_{section['SIS ID']},{section['Section Name']},{section['Section Number']},,{section['SIS ID']},{datetime_str},{datetime_str},True,edp_{section['Course SIS ID']},{ref_section_type},edp_{section['Term SIS ID']},edp_{section['School SIS ID']}\n"
+            m365_data['Section'].append({'Id': f"edp_{section['SIS ID']}", 'Name': section['Section Name'], 'Code': section['Section Number'], 'Location': '', 'ExternalId': section['SIS ID'],
+                                         'CreateDate': datetime_str, 'LastModifiedDate': datetime_str, 'IsActive': 'True', 'CourseId': f"edp_{section['Course SIS ID']}",
+                                         'RefSectionTypeId': ref_section_type, 'SessionId': f"edp_{section['Term SIS ID']}", 'OrgId': f"edp_{section['School SIS ID']}"})
         for course in school['_courses']:
-        # columns for DIP csv are: Id,Name,Code,Description,ExternalId,CreateDate,LastModifiedDate,IsActive,CalendarId
-            m365_data['Course'] += f"edp_{course['Course SIS ID']},{course['Course Name']},{course['Course Number']},{course['Course Description']},{course['Course SIS ID']},8/13/2020 10:36:44 AM,8/15/2020 11:36:00 PM,True,{course['_calendar_id']}\n"
-
+            m365_data['Course'].append({'Id': f"edp_{course['Course SIS ID']}", 'Name': course['Course Name'], 'Code': course['Course Number'], 'Description': course['Course Description'],
+                                        'ExternalId': course['Course SIS ID'], 'CreateDate': '8/13/2020 10:36:44 AM', 'LastModifiedDate': '8/15/2020 11:36:00 PM', 'IsActive': 'True',
+                                        'CalendarId': course['_calendar_id']})
         return m365_data
 
+    def create_person_row(self, person, datetime_str, source_system_id):
+        return {'Id': f"edp_{person['SIS ID']}", 'FirstName': person['First Name'], 'MiddleName': person['Middle Name'], 'LastName': person['Last Name'], 'GenerationCode': '', 'Prefix': '',
+                'EnabledUser': 'True', 'ExternalId': person['SIS ID'], 'CreateDate': datetime_str, 'LastModifiedDate': datetime_str, 'IsActive': 'True', 'SourceSystemId': source_system_id}
+
+    def create_person_identifier_rows(self, person, ref_upn_id, ref_aad_id, datetime_str, source_system_id):
+        """ Returns the PersonIdentifier rows of the person: their upn and their aad id. """
+        rows = []
+        for n, identifier, ref_identifier_type_id in [(1, person['_upn'], ref_upn_id), (2, person['_aad'], ref_aad_id)]:
+            rows.append({'Id': f"edp_pi{n}_{person['SIS ID']}", 'Identifier': identifier, 'Description': '', 'RefIdentifierTypeId': ref_identifier_type_id, 'ExternalId': f"pi{n}_{person['SIS ID']}",
+                         'CreateDate': datetime_str, 'LastModifiedDate': datetime_str, 'IsActive': 'True', 'PersonId': f"edp_{person['SIS ID']}", 'SourceSystemId': source_system_id})
+        return rows
+
     def create_terms(self, calendar_id):
         terms = []
         terms.append({
@@ -174,8 +217,8 @@ class MSInsightsDataGenerator:
             'Term StartDate': '9/1/2019',
             'Term EndDate': '12/22/2019',
             '_sections': [],
-            # this is an array of arrays representing the sections and the spots (available seats) within each section
-            '_section_spots': [],
+            # the sections and the spots (available seats) left within each section
+            '_section_spots': DataGenUtil.SectionSeatAllocator(),
             '_calendar_id': calendar_id
         })
         self.term_id += 1
@@ -185,7 +228,7 @@ class MSInsightsDataGenerator:
             'Term StartDate': '1/21/2020',
             'Term EndDate': '5/30/2020',
             '_sections': [],
-            '_section_spots': [],
+            '_section_spots': DataGenUtil.SectionSeatAllocator(),
             '_calendar_id': calendar_id
         })
         self.term_id += 1
@@ -297,10 +340,7 @@ class MSInsightsDataGenerator:
                 'Status': 'Active' if self.include_optional else ''
             })
             # add section spots
-            spots = []
-            for i in range(self.students_per_section):
-                spots.append('sec' + str(self.section_id))
-            term['_section_spots'].append(spots)
+            term['_section_spots'].add_section('sec' + str(self.section_id), self.students_per_section)
             self.section_id += 1
 
     def get_grade_ref(self, grade_str):
@@ -313,58 +353,68 @@ class MSInsightsDataGenerator:
         ref_student_section_role = 'D1CA502E-DB62-41D2-B438-AC669E6A9663'
         datetime_str = "8/13/2020 10:09:43 AM"
         mark_id = 1
-        school['_student_section_membership'] = ''
-        school['_attendance'] = ''
-        school['_section_marks'] = ''
+        student_section_membership = []
+        attendance = []
+        section_marks = []
 
         for student in school['_students']:
             for term in school['_terms']:
-                num_enrollments = 0
-                for section_spots in term['_section_spots']:
-                    if(len(section_spots) == 0): 
-                        continue
-                    else:
-                        spot_taken = section_spots.pop()
-                        student['_section_ids'].append(spot_taken)
-                        school['_student_section_membership'] += f"edp_ssm_{student['SIS ID']},,,ssm_{student['SIS ID']},{datetime_str},{datetime_str},True,edp_{student['SIS ID']},,{ref_student_section_role},edp_{spot_taken}\n"
-                        num_enrollments += 1
-                        school['_attendance'] += f"att_{student['SIS ID']},{student['SIS ID']},{self.school_year},{school['SIS ID']},8/15/2020,No,1,{spot_taken},P,1,Present,ClassSectionAttendance,0\n"
-                        grade = self.get_random_grade()
-                        credits_earned = 5
-                        if grade[1] == 'F': credits_earned = 0
-                        school['_section_marks'] += f"m{mark_id},{student['SIS ID']},{spot_taken},,{term['Term SIS ID']},{grade[0]},{grade[1]},No,5,{credits_earned},\n"
-                        mark_id += 1
-                    if (num_enrollments >= self.classes_in_student_schedule): break        
+                for spot_taken in term['_section_spots'].allocate(self.classes_in_student_schedule):
+                    student['_section_ids'].append(spot_taken)
+                    student_section_membership.append({'Id': f"edp_ssm_{student['SIS ID']}", 'EntryDate': '', 'ExitDate': '', 'ExternalId': f"ssm_{student['SIS ID']}", 'CreateDate': datetime_str,
+                                                       'LastModifiedDate': datetime_str, 'IsActive': 'True', 'PersonId': f"edp_{student['SIS ID']}", 'RefGradeLevelWhenCourseTakenId': '',
+                                                       'RefStudentSectionRoleId': ref_student_section_role, 'SectionId': f"edp_{spot_taken}"})
+                    attendance.append({'id': f"att_{student['SIS ID']}", 'student_id': student['SIS ID'], 'school_year': self.school_year, 'school_id': school['SIS ID'],
+                                       'attendance_date': '8/15/2020', 'all_day': 'No', 'Period': 1, 'section_id': spot_taken, 'AttendanceCode': 'P', 'PresenceFlag': 1,
+                                       'attendance_status': 'Present', 'attendance_type': 'ClassSectionAttendance', 'attendance_sequence': 0})
+                    grade = self.get_random_grade()
+                    credits_earned = 5
+                    if grade[1] == 'F': credits_earned = 0
+                    section_marks.append({'id': f"m{mark_id}", 'student_id': student['SIS ID'], 'section_id': spot_taken, 'school_year': '', 'term_id': term['Term SIS ID'],
+                                          'numeric_grade_earned': grade[0], 'alpha_grade_earned': grade[1], 'is_final_grade': 'No', 'credits_attempted': 5,
+                                          'credits_earned': credits_earned, 'grad_credit_type': ''})
+                    mark_id += 1
+
+        school['_student_section_membership'] = student_section_membership
+        school['_attendance'] = attendance
+        school['_section_marks'] = section_marks
 
     def add_teacher_data(self, school):
         ref_staff_section_role = 'C943E793-2DB7-47C0-B187-A9ED65EEBD5B'
         datetime_str = "8/13/2020 10:09:43 AM"
-        school['_staff_section_membership'] = ''
+        staff_section_membership = []
         for term in school['_terms']:
             teacher_index = 0
             for section in term['_sections']:
                 teacher = school['_teachers'][teacher_index]
                 teacher['_section_ids'].append(section['SIS ID'])
-                school['_staff_section_membership'] += f"edp_ssm_{teacher['SIS ID']},True,,,ssm_{teacher['SIS ID']},{datetime_str},{datetime_str},True,edp_{teacher['SIS ID']},{ref_staff_section_role},edp_{section['SIS ID']}\n"
+                staff_section_membership.append({'Id': f"edp_ssm_{teacher['SIS ID']}", 'IsPrimaryStaffForSection': 'True', 'EntryDate': '', 'ExitDate': '', 'ExternalId': f"ssm_{teacher['SIS ID']}",
+                                                 'CreateDate': datetime_str, 'LastModifiedDate': datetime_str, 'IsActive': 'True', 'PersonId': f"edp_{teacher['SIS ID']}",
+                                                 'RefStaffSectionRoleId': ref_staff_section_role, 'SectionId': f"edp_{section['SIS ID']}"})
                 teacher_index += 1
                 if (teacher_index == len(school['_teachers'])):
                     teacher_index = 0  # start over from the beginning of the list of teachers
+        school['_staff_section_membership'] = staff_section_membership
 
-    def create_and_write_activity_data(self, people, path_and_filename, writer):
+    def create_and_write_activity_data(self, people, stream):
+        """ Writes the activity rows of the given people to the given row stream (see DataGenUtil.open_row_stream). """
         signal_id_counter = 100
         signal_types = ['VisitTeamChannel', 'ReactedWithEmoji', 'PostChannelMessage', 'ReplyChannelMessage', 'ExpandChannelMessage', 'CallRecordSummarized', 'FileAccessed', 'FileDownloaded',
                         'FileModified', 'FileUploaded', 'ShareNotificationRequested', 'CommentCreated', 'UserAtMentioned', 'AddedToSharedWithMe', 'CommentDeleted', 'Unlike']
-        agents = ['', '"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.182 Safari/537.36 Edg/88.0.705.74"', '"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Teams/1.3.00.34662 Chrome/80.0.3987.165 Electron/8.5.1 Safari/537.36"',
-                '"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.141 Safari/537.36"', '"Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:78.0) Gecko/20100101 Firefox/78.0"']
+        # the user agents have commas in them, so they're quoted when written as csv
+        agents = ['', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.182 Safari/537.36 Edg/88.0.705.74', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Teams/1.3.00.34662 Chrome/80.0.3987.165 Electron/8.5.1 Safari/537.36',
+                'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.141 Safari/537.36', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:78.0) Gecko/20100101 Firefox/78.0']
         applications = ['Other apps', 'Teams', 'PowerPoint', 'Excel', 'PDF viewers', 'Media apps', 'Image apps', 'Word']
         learning_activities = ['Communications', 'Assignments', 'Meetings']
 
         # activity_csv.write('SignalType,StartTime,UserAgent,SignalId,SISClassId,OfficeClassId,ChannelId,AppName,ActorId,ActorRole,SchemaVersion,AssignmentId,SubmissionId,Action,AssginmentDueDate,ClassCreationDate,Grade,SourceFileExtension,MeetingDuration')
+        if self.activity_end_time is None: start_date, end_date = '-60d', 'now'
+        else: start_date, end_date = self.activity_end_time - datetime.timedelta(days=60), self.activity_end_time
         num_of_entries_for_person = self.faker.pyint(min_value=self.activity_min_per_person, max_value=self.activity_max_per_person)
         for i in range(num_of_entries_for_person):
             for person in people:
                 signal_type = random.choice(signal_types)
-                start_time = f"{self.faker.date_time_between(start_date='-60d', end_date='now', tzinfo=None)}.0000000"
+                start_time = f"{self.faker.date_time_between(start_date=start_date, end_date=end_date, tzinfo=None)}.0000000"
                 agent = random.choice(agents)
                 signal_id = self.faker.uuid4()
                 sis_class_id = random.choice(person['_section_ids'])
@@ -389,8 +439,10 @@ class MSInsightsDataGenerator:
                 minutes = self.faker.pyint(min_value=0, max_value=59)
                 meeting_duration = f'00:{hours:02}:{minutes:02}'
 
-                # SignalType,StartTime,UserAgent,SignalId,SISClassId,OfficeClassId,ChannelId,AppName,ActorId,ActorRole,SchemaVersion,AssignmentId,SubmissionId,Action,AssginmentDueDate,ClassCreationDate,Grade,SourceFileExtension,MeetingDuration
-                writer.write(path_and_filename, f"{signal_type},{start_time},{agent},{signal_id},{sis_class_id},{office_class_id},{channel_id},{app_name},{actor_id},{actor_role},{schema_version},{assignmentId},{submissionId},{action},{assginment_due_date},{class_creation_date},{grade},{source_file_extension},{meeting_duration}\n")
+                stream.write_row({'SignalType': signal_type, 'StartTime': start_time, 'UserAgent': agent, 'SignalId': signal_id, 'SISClassId': sis_class_id, 'OfficeClassId': office_class_id,
+                                  'ChannelId': channel_id, 'AppName': app_name, 'ActorId': actor_id, 'ActorRole': actor_role, 'SchemaVersion': schema_version, 'AssignmentId': assignmentId,
+                                  'SubmissionId': submissionId, 'Action': action, 'AssginmentDueDate': assginment_due_date, 'ClassCreationDate': class_creation_date, 'Grade': grade,
+                                  'SourceFileExtension': source_file_extension, 'MeetingDuration': meeting_duration})
 
     def get_fake_school_name(self):
         name = self.faker.last_name()
@@ -408,22 +460,20 @@ class MSInsightsDataGenerator:
         return [str(num), grade]
 
     def list_of_dict_to_csv(self, list_of_dict):
-        csv_str = ''
-        header = []
-        for column_name in list_of_dict[0].keys(): 
-            if not column_name.startswith('_'): header.append(column_name)
-        csv_str += ",".join(header) + "\n"
+        return DataGenUtil.list_of_dict_to_csv(list_of_dict)[:-1] # chop the final newline char
 
-        for row in list_of_dict:
-            csv_str += self.obj_to_csv(row) + "\n"
+    def obj_to_csv(self, obj):
+        return DataGenUtil.obj_to_csv(obj)
 
-        return csv_str[:-1] # chop the final newline char
+REF_DEFINITION_COLUMNS = ['Id', 'RefType', 'Namespace', 'Code', 'SortOrder', 'Description', 'IsActive']
 
-    def obj_to_csv(self, obj):
-        csv = ''
-        for key in obj:
-            if not (key.startswith('_')): csv += str(obj[key]) + ','
-        return csv[:-1]        
+def get_ref_definition_rows():
+    """ Returns the rows of REF_DEFINITION_CSV as dicts. Some descriptions have commas in them, so the fields between the sort order and the last one are the description. """
+    rows = []
+    for line in REF_DEFINITION_CSV.strip().splitlines():
+        values = line.strip().split(',')
+        rows.append(dict(zip(REF_DEFINITION_COLUMNS, values[:5] + [','.join(values[5:-1]), values[-1]])))
+    return rows
 
 REF_DEFINITION_CSV="""
     F27548AC-5978-4DC7-8897-1F51FBBD269F,RefPhoneNumberType,ceds.ed.gov,Home,10,Home,True
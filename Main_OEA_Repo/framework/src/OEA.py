@@ -1,10 +1,15 @@
 
 from delta.tables import DeltaTable
 from notebookutils import mssparkutils
-from pyspark.sql.types import StructType, StructField, StringType, IntegerType, DoubleType, ArrayType, TimestampType, BooleanType, ShortType
+from pyspark.sql.types import StructType, StructField, StringType, IntegerType, DoubleType, ArrayType, TimestampType, BooleanType, ShortType, \
+    LongType, FloatType, ByteType, BinaryType, DateType, DecimalType, MapType
 from pyspark.sql import functions as F
 from pyspark.sql.utils import AnalysisException
 import logging
+import os
+import math
+import time
+import collections
 import pandas as pd
 import sys
 import re
@@ -12,11 +17,145 @@ import json
 import datetime
 import random
 import io
+import hashlib
+import concurrent.futures
+import warnings
+import threading
+import uuid
+import contextlib
+import functools
 
 logger = logging.getLogger('OEA')
+span_logger = logging.getLogger('OEA.spans') # only sends spans to App Insights (see OEA.span)
+span_logger.propagate = False
+
+# The type names that can be used in OEA schemas, in addition to decimal(precision,scale), array<type>, map<key type,value type> and struct<name:type,...>
+SPARK_TYPES = {'string': StringType, 'integer': IntegerType, 'int': IntegerType, 'short': ShortType, 'long': LongType, 'bigint': LongType, 'byte': ByteType,
+               'double': DoubleType, 'float': FloatType, 'boolean': BooleanType, 'timestamp': TimestampType, 'date': DateType, 'binary': BinaryType}
+# The size of the files OEA.optimize compacts delta tables into when no target_file_size is given (the default of Delta's OPTIMIZE)
+DEFAULT_TARGET_FILE_SIZE = 1024 * 1024 * 1024
+
+def _parse_spark_type(tokens, pos):
+    """ Parses the type starting at tokens[pos] and returns it along with the position of the token that follows it. """
+    def expect(token, pos):
+        if tokens[pos] != token: raise ValueError(f"expected '{token}' but found '{tokens[pos]}'")
+        return pos + 1
+
+    name = tokens[pos].lower()
+    pos += 1
+    if name in SPARK_TYPES:
+        return SPARK_TYPES[name](), pos
+    elif name == 'decimal':
+        precision, scale = 10, 0
+        if pos < len(tokens) and tokens[pos] == '(':
+            precision = int(tokens[pos + 1])
+            pos += 2
+            if tokens[pos] == ',':
+                scale = int(tokens[pos + 1])
+                pos += 2
+            pos = expect(')', pos)
+        return DecimalType(precision, scale), pos
+    elif name == 'array':
+        element_type, pos = _parse_spark_type(tokens, expect('<', pos))
+        return ArrayType(element_type, True), expect('>', pos)
+    elif name == 'map':
+        key_type, pos = _parse_spark_type(tokens, expect('<', pos))
+        value_type, pos = _parse_spark_type(tokens, expect(',', pos))
+        return MapType(key_type, value_type, True), expect('>', pos)
+    elif name == 'struct':
+        fields = []
+        pos = expect('<', pos)
+        while tokens[pos] != '>':
+            if fields: pos = expect(',', pos)
+            field_name = tokens[pos]
+            field_type, pos = _parse_spark_type(tokens, expect(':', pos + 1))
+            fields.append(StructField(field_name, field_type, True))
+        return StructType(fields), pos + 1
+    raise ValueError(f"unknown type '{name}'")
+
+def _infer_oea_type(values):
+    """ Infers the OEA type of the values in a pandas series (returns None if they're all null). """
+    values = values.dropna()
+    if len(values) == 0: return None
+    if pd.api.types.is_bool_dtype(values): return 'boolean'
+    if pd.api.types.is_numeric_dtype(values):
+        if not (values == values.round()).all(): return 'double'
+        return 'integer' if values.abs().max() < 2**31 else 'long'
+    strings = values.astype(str)
+    if strings.str.lower().isin(['true', 'false']).all(): return 'boolean'
+    if not strings.str.match(r"\d{1,4}[-/.]\d{1,2}[-/.]\d{1,4}").all(): return 'string' # dateutil would otherwise read values like 'st1' as dates
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # pandas warns when it can't infer a datetime format
+        timestamps = pd.to_datetime(strings.map(lambda value: pd.to_datetime(value, errors='coerce'))) # parsed one by one, as the formats may vary between rows
+    if timestamps.notna().all():
+        if (timestamps == timestamps.dt.normalize()).all() and strings.str.len().max() <= 10: return 'date'
+        return 'timestamp'
+    return 'string'
+
+def _widen_oea_types(type1, type2):
+    """ Returns the type that can hold the values of both types (eg, integer and double widen to double). """
+    if type1 is None or type1 == type2: return type2
+    if type2 is None: return type1
+    numeric_types = ['integer', 'long', 'double']
+    if type1 in numeric_types and type2 in numeric_types: return numeric_types[max(numeric_types.index(type1), numeric_types.index(type2))]
+    if set([type1, type2]) == set(['date', 'timestamp']): return 'timestamp'
+    return 'string'
+
+def _is_identifier_column(col_name, values):
+    """ Returns True if the column looks like it identifies a person (eg, 'StudentId', 'ActorId', 'email'), and should be hashed. """
+    name = re.sub(r"[ _]", '', col_name).lower()
+    if re.search(r"mail|upn|userprincipalname", name): return True
+    if not re.search(r"(id|ID|Id)$", col_name) or name.endswith('valid') or name.endswith('paid'): return False
+    if re.search(r"person|student|user|actor|teacher|staff|aad|object|sis|external", name): return True
+    values = values.dropna()
+    return len(values) > 0 and values.nunique() / len(values) >= 0.9 # a (nearly) unique id is likely the key of a roster entity
+
+def _parse_json_array_prefix(text):
+    """ Parses the elements of the json array at the start of the given text (eg, the first bytes of a .json file) and returns them as a list.
+        The array may be cut off: parsing stops at the first element that is incomplete.
+    """
+    decoder = json.JSONDecoder()
+    rows = []
+    pos = text.index('[') + 1
+    while True:
+        while pos < len(text) and text[pos] in ' \t\r\n,': pos += 1
+        if pos >= len(text) or text[pos] == ']': return rows
+        try:
+            row, pos = decoder.raw_decode(text, pos)
+        except ValueError:
+            return rows
+        rows.append(row)
+
+def _partition_value_predicate(col_name, value):
+    """ Returns a sql predicate that matches the rows of the partition with the given value of col_name (eg, for a replaceWhere). """
+    if value is None: return f"`{col_name}` is null"
+    if isinstance(value, bool): return f"`{col_name}` = {str(value).lower()}"
+    if isinstance(value, (int, float)): return f"`{col_name}` = {value}"
+    escaped_value = str(value).replace('\\', '\\\\').replace("'", "\\'")
+    return f"`{col_name}` = '{escaped_value}'"
+
+def _is_thread_pinned():
+    """ Returns whether pyspark runs each python thread on its own jvm thread (PYSPARK_PIN_THREAD, which is on by default from Spark 3.2).
+        Local properties set in a thread (like its scheduler pool) only reliably apply to that thread's jobs in this mode.
+    """
+    default = 'true' if tuple([int(n) for n in spark.version.split('.')[:2]]) >= (3, 2) else 'false'
+    return os.environ.get('PYSPARK_PIN_THREAD', default).lower() == 'true'
+
+def _instrumented(span_name, target_arg=0):
+    """ Records a span (see OEA.span) for each call of the decorated OEA or BaseOEAModule method, with the arg at target_arg (eg, a path or entity name) as the span's target
+        (or no target if target_arg is None).
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            oea = self if isinstance(self, OEA) else self.oea
+            with oea.span(span_name, target=str(args[target_arg]) if target_arg is not None and len(args) > target_arg else None):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
 class OEA:
-    def __init__(self, storage_account='', instrumentation_key='', salt='', logging_level=logging.DEBUG):
+    def __init__(self, storage_account='', instrumentation_key='', salt='', logging_level=logging.DEBUG, listing_parallelism=16, listing_cache_ttl=0, span_sink_path=None, max_spans=10000):
         if storage_account:
             self.storage_account = storage_account
         else:
@@ -31,6 +170,17 @@ class OEA:
         self.stage3np = 'abfss://stage3np@' + self.storage_account + '.dfs.core.windows.net'
         self.stage3p = 'abfss://stage3p@' + self.storage_account + '.dfs.core.windows.net'
         self.framework_path = 'abfss://oea-framework@' + self.storage_account + '.dfs.core.windows.net'
+        # number of concurrent mssparkutils.fs.ls calls when walking the lake (see list_tree), and the number of seconds a listing is reused for (0 disables the cache)
+        self.listing_parallelism = listing_parallelism
+        self.listing_cache_ttl = listing_cache_ttl
+        self.listing_cache = {}
+        self.spark_schemas = {} # spark schemas built by to_spark_schema, keyed by the (column name, type) pairs of the OEA schema
+        # the last max_spans spans recorded for the framework operations (see span; None keeps them all and 0 none, eg when they're only needed in the sink),
+        # also appended as json lines to the local file at span_sink_path if given (eg, '/tmp/oea_spans.jsonl')
+        self.spans = collections.deque(maxlen=max_spans)
+        self.span_sink_path = span_sink_path
+        self._span_lock = threading.Lock()
+        self._span_state = threading.local()
 
         logger.debug("OEA initialized.")
 
@@ -47,12 +197,132 @@ class OEA:
         handler.setFormatter(formatter)
         logger.addHandler(handler) 
 
+        if instrumentation_key:
+            try:
+                from opencensus.ext.azure.log_exporter import AzureLogHandler
+            except ImportError:
+                logger.warning("[OEA] opencensus-ext-azure is not installed, so logs and spans will not be sent to App Insights.")
+                return
+            azure_handler = AzureLogHandler(connection_string=f"InstrumentationKey={instrumentation_key}")
+            azure_handler.setLevel(logging_level)
+            logger.addHandler(azure_handler)
+            span_logger.addHandler(azure_handler)
+            span_logger.setLevel(logging.INFO)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """ Records a span for a framework operation: its duration, status, its span_id, the span it's nested in (parent_id, and its name as parent),
+            and any values set on it while it runs (the framework sets rows_in, rows_out, bytes_written and files_written where they're known, see record).
+            The last max_spans spans are kept in self.spans; every span is appended to the span_sink_path file as json lines, and sent to App Insights if an instrumentation_key was given.
+            Ex: with oea.span('load_roster', entity='Person') as span:
+                    span['rows_in'] = df.count()
+        """
+        stack = self._get_span_stack()
+        parent = stack[-1] if stack else {}
+        record = {'name': name, 'span_id': uuid.uuid4().hex[:16], 'parent_id': parent.get('span_id'), 'parent': parent.get('name'), 'start_time': datetime.datetime.utcnow().isoformat()}
+        record.update(attributes)
+        stack.append(record)
+        start = time.time()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = str(e)
+            raise
+        finally:
+            stack.pop()
+            record['seconds'] = round(time.time() - start, 3)
+            self._export_span(record)
+
+    def record(self, **values):
+        """ Sets the given values (eg, rows_out=100) on the innermost span that is running in the current thread, if any. """
+        stack = self._get_span_stack()
+        if stack: stack[-1].update(values)
+
+    def _get_span_stack(self):
+        if not hasattr(self._span_state, 'stack'): self._span_state.stack = []
+        return self._span_state.stack
+
+    def _export_span(self, record):
+        with self._span_lock:
+            self.spans.append(record)
+            if self.span_sink_path:
+                with open(self.span_sink_path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+        custom_dimensions = {key: (value if isinstance(value, (int, float, str, bool)) else str(value)) for key, value in record.items() if value is not None}
+        span_logger.info(f"[OEA span] {record['name']}", extra={'custom_dimensions': custom_dimensions})
+
+    def _get_last_operation_metrics(self, path):
+        """ Returns the metrics (eg, numOutputRows, numOutputBytes, numFiles) of the last operation on the delta table at the given path. """
+        return DeltaTable.forPath(spark, path).history(1).collect()[0]['operationMetrics']
+
     def load(self, folder, table, stage=None, data_format='delta'):
         """ Loads a dataframe based on the path specified in the given args """
         if stage is None: stage = self.stage2p
         df = spark.read.load(f"{stage}/{folder}/{table}", format=data_format)
         return df
 
+    @_instrumented('upsert', target_arg=1)
+    def upsert(self, df, path, keys, partition_predicate=None, delete_missing=False, partition_columns=None, check_duplicates=False):
+        """ Merges the given df into the delta table at the given path: rows with matching keys are updated (only if one of their values changed),
+            and the other rows are inserted. If the table doesn't exist yet, it's created with the df (partitioned by the given partition_columns).
+            partition_predicate is an optional condition on the target rows (eg, "target.school_year = 2021") that limits the files the merge reads and rewrites.
+            Every row of the df must satisfy it too (with 'target.' read as the df's columns), since a row whose match is outside the predicate would be inserted
+            as a duplicate; a ValueError is raised otherwise. With delete_missing=True, the target rows (within the partition_predicate) that are not in the df are deleted
+            (in the merge itself on Delta 2.3+, and with a second merge of the missing keys on older versions, see _delete_missing).
+            If the df has more than one row for the same keys, only one of them (an arbitrary one) is merged. With check_duplicates=True, the df is scanned for such keys first
+            and a warning is logged if there are any; this costs an extra pass over the df, so it's off by default (leave it off if the df is already deduplicated).
+            Returns the number of source rows and of the rows inserted, updated and deleted, as reported by the delta table history.
+            Ex: oea.upsert(df, oea.stage2np + '/m365/Person', ['Id'])
+        """
+        if isinstance(keys, str): keys = [keys]
+        if not DeltaTable.isDeltaTable(spark, path):
+            df.write.format('delta').partitionBy(*(partition_columns or [])).save(path)
+            metrics = self._get_last_operation_metrics(path)
+            self.record(rows_out=int(metrics.get('numOutputRows', 0)), bytes_written=int(metrics.get('numOutputBytes', 0)), files_written=int(metrics.get('numFiles', 0)))
+            return {'source_rows': int(metrics.get('numOutputRows', 0)), 'inserted': int(metrics.get('numOutputRows', 0)), 'updated': 0, 'deleted': 0}
+
+        condition = ' and '.join([f"target.`{key}` <=> updates.`{key}`" for key in keys])
+        if partition_predicate:
+            condition += f" and ({partition_predicate})"
+            source_predicate = re.sub(r"\btarget\.", 'updates.', partition_predicate)
+            rows_outside = df.alias('updates').where(f"not coalesce({source_predicate}, false)").count()
+            if rows_outside: raise ValueError(f"{rows_outside} rows to upsert into {path} are outside the partition_predicate: {partition_predicate}")
+        if check_duplicates:
+            duplicate_keys = df.groupBy([F.col(f"`{key}`") for key in keys]).count().where(F.col('count') > 1).count()
+            if duplicate_keys: logger.warning(f"[OEA] {duplicate_keys} keys have more than one row in the data to upsert into {path}; only one row (an arbitrary one) is merged for each.")
+        changed = ' or '.join([f"not (target.`{col}` <=> updates.`{col}`)" for col in df.columns if col not in keys])
+        updates = df.dropDuplicates(keys) # a merge fails if more than one source row matches the same target row
+        merge = DeltaTable.forPath(spark, path).alias('target').merge(updates.alias('updates'), condition)
+        if changed: merge = merge.whenMatchedUpdateAll(condition=changed)
+        merge = merge.whenNotMatchedInsertAll()
+        delete_in_merge = delete_missing and hasattr(merge, 'whenNotMatchedBySourceDelete') # whenNotMatchedBySourceDelete was added in Delta 2.3
+        if delete_in_merge: merge = merge.whenNotMatchedBySourceDelete(condition=partition_predicate)
+        merge.execute()
+
+        metrics = self._get_last_operation_metrics(path)
+        result = {'source_rows': int(metrics.get('numSourceRows', 0)), 'inserted': int(metrics.get('numTargetRowsInserted', 0)), 'updated': int(metrics.get('numTargetRowsUpdated', 0)),
+                  'deleted': int(metrics.get('numTargetRowsDeleted', 0))}
+        if delete_missing and not delete_in_merge: result['deleted'] = self._delete_missing(df, path, keys, partition_predicate)
+        self.record(rows_in=result['source_rows'], rows_out=result['inserted'] + result['updated'], rows_deleted=result['deleted'],
+                    bytes_written=int(metrics.get('numTargetBytesAdded', 0)), files_written=int(metrics.get('numTargetFilesAdded', 0)))
+        logger.info(f"[OEA] Upserted into {path}: {result}")
+        return result
+
+    def _delete_missing(self, df, path, keys, partition_predicate=None):
+        """ Deletes the rows of the delta table at the given path (within the partition_predicate) whose keys are not in the df, and returns the number of rows deleted.
+            This is used by upsert on Delta versions before 2.3, which don't have whenNotMatchedBySourceDelete: the missing keys are found with an anti join
+            and deleted with a second merge (DeltaTable.delete doesn't take a condition with a subquery).
+        """
+        key_condition = ' and '.join([f"target.`{key}` <=> updates.`{key}`" for key in keys])
+        target = spark.read.format('delta').load(path).alias('target')
+        if partition_predicate: target = target.where(partition_predicate)
+        missing = target.join(df.alias('updates'), F.expr(key_condition), 'left_anti').select([F.col(f"`{key}`") for key in keys])
+        condition = key_condition if not partition_predicate else f"{key_condition} and ({partition_predicate})"
+        DeltaTable.forPath(spark, path).alias('target').merge(missing.alias('updates'), condition).whenMatchedDelete().execute()
+        return int(self._get_last_operation_metrics(path).get('numTargetRowsDeleted', 0))
+
     def load_from_stage1(self, path_and_filename, data_format='csv'):
         """ Loads a dataframe with data from stage1, based on the path specified in the given args """
         path = f"{self.stage1np}/{path_and_filename}"
@@ -63,28 +333,93 @@ class OEA:
         """ Loads a sample from the specified csv file and returns a pandas dataframe.
             Ex: print(load_sample_from_csv_file('/student_data/students.csv'))
         """
+        return self.load_sample(path_and_filename, 'csv', header=header, stage=stage)
+
+    def load_sample(self, path_and_filename, format=None, max_bytes=65536, max_rows=1000, header=True, stage=None):
+        """ Loads a sample of the specified file and returns it as a pandas dataframe. The format ('csv', 'json', 'jsonl' or 'parquet') is taken from the file extension if not given.
+            For csv, json and json-lines files, only the first max_bytes are read and the last (partial) line or array element is dropped.
+            A json file can hold an array of objects (like the EdFi files from DataGenUtil.list_of_dict_to_json) or one object per line.
+            If the path is a folder of csv or json part files written by spark, the first part is sampled.
+            For parquet files, the first max_rows rows are read with spark, which only reads the file footer and the row groups needed.
+            Ex: print(oea.load_sample('/m365/DIPData/Roster/Person.csv', header=False))
+        """
         if stage is None: stage = self.stage1np
-        csv_str = mssparkutils.fs.head(f"{stage}/{path_and_filename}") # https://docs.microsoft.com/en-us/azure/synapse-analytics/spark/microsoft-spark-utilities?pivots=programming-language-python#preview-file-content
-        complete_lines = re.match(r".*\n", csv_str, re.DOTALL).group(0)
-        if header: header = 0 # for info on why this is needed: https://pandas.pydata.org/pandas-docs/dev/reference/api/pandas.read_csv.html
-        else: header = None
-        pdf = pd.read_csv(io.StringIO(complete_lines), sep=',', header=header)
-        return pdf
+        path = f"{stage}/{path_and_filename}"
+        if format is None: format = self._get_sample_format(path_and_filename)
+        if format == 'parquet':
+            return spark.read.parquet(path).limit(max_rows).toPandas()
+
+        try:
+            text = mssparkutils.fs.head(path, max_bytes) # https://docs.microsoft.com/en-us/azure/synapse-analytics/spark/microsoft-spark-utilities?pivots=programming-language-python#preview-file-content
+        except Exception:
+            part_files = self.get_files(path, recursive=False) # the path may be a folder of part files written by spark (eg, by write_rows_as_csv)
+            if not part_files: raise
+            text = mssparkutils.fs.head(part_files[0]['path'], max_bytes)
+        end_of_last_line = text.rfind('\n')
+        if end_of_last_line >= 0 and len(text.encode('utf-8')) >= max_bytes: text = text[:end_of_last_line + 1] # the file was cut off, so the last line may be incomplete
+        if format == 'csv':
+            if header: header = 0 # for info on why this is needed: https://pandas.pydata.org/pandas-docs/dev/reference/api/pandas.read_csv.html
+            else: header = None
+            return pd.read_csv(io.StringIO(text), sep=',', header=header, nrows=max_rows)
+        elif format == 'json' and text.lstrip().startswith('['):
+            return pd.DataFrame(_parse_json_array_prefix(text)).head(max_rows)
+        elif format in ('jsonl', 'json'):
+            return pd.read_json(io.StringIO(text), lines=True).head(max_rows)
+        raise ValueError(f"Unsupported sample format: {format}")
+
+    def _get_sample_format(self, path_and_filename):
+        extension = os.path.splitext(path_and_filename)[1].lower()
+        if extension == '.parquet': return 'parquet'
+        elif extension == '.json': return 'json'
+        elif extension in ('.jsonl', '.ndjson'): return 'jsonl'
+        return 'csv'
+
+    def load_samples(self, paths_and_filenames, format=None, max_bytes=65536, max_rows=1000, header=True, stage=None):
+        """ Loads samples of the specified files concurrently (up to listing_parallelism at a time), and returns a dict of pandas dataframes keyed by path.
+            The files that can't be sampled are logged and mapped to None.
+            Ex: samples = oea.load_samples([f['path'][len(oea.stage1np):] for f in oea.get_files(oea.stage1np + '/m365')])
+        """
+        def load(path_and_filename):
+            try:
+                return self.load_sample(path_and_filename, format, max_bytes, max_rows, header, stage)
+            except Exception as e:
+                logger.warning(f"[OEA] Could not load a sample of {path_and_filename}: {e}")
+                return None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.listing_parallelism) as executor:
+            return dict(zip(paths_and_filenames, executor.map(load, paths_and_filenames)))
 
     def print_stage(self, path):
         """ Prints out the highlevel contents of the specified stage."""
         msg = path + "\n"
-        folders = self.get_folders(path)
-        for folder_name in folders:
-            entities = self.get_folders(path + '/' + folder_name)
-            msg += f"{folder_name}: {entities}\n"
-        print(msg)            
+        folders = self.list_tree(path, max_depth=2, include_files=False)
+        for folder in [f for f in folders if f['depth'] == 1]:
+            entities = [f['name'] for f in folders if f['parent'] == folder['path']]
+            msg += f"{folder['name']}: {entities}\n"
+        print(msg)
 
     def fix_column_names(self, df):
         """ Fix column names to satisfy the Parquet naming requirements by substituting invalid characters with an underscore. """
-        df_with_valid_column_names = df.select([F.col(col).alias(re.sub("[ ,;{}()\n\t=]+", "_", col)) for col in df.columns])
+        df_with_valid_column_names = df.select([F.col(col).alias(self._valid_column_name(col)) for col in df.columns])
         return df_with_valid_column_names
 
+    def _valid_column_name(self, col_name):
+        return re.sub("[ ,;{}()\n\t=]+", "_", col_name)
+
+    def to_spark_type(self, dtype):
+        """ Returns the spark data type for the given OEA type name, which can be a simple type (eg, 'string', 'timestamp', 'date', 'long')
+            or a decimal, array, map or struct type written like in spark sql, eg: 'decimal(10,2)', 'array<string>', 'struct<id:string,grades:array<short>>'
+            Raises a ValueError if the type name is not valid.
+        """
+        tokens = re.findall(r"[<>(),:]|[^<>(),:\s]+", dtype)
+        try:
+            data_type, pos = _parse_spark_type(tokens, 0)
+        except ValueError as e:
+            raise ValueError(f"Invalid type in OEA schema: '{dtype}' ({e})")
+        except IndexError:
+            raise ValueError(f"Invalid type in OEA schema: '{dtype}' (incomplete type)")
+        if pos != len(tokens): raise ValueError(f"Invalid type in OEA schema: '{dtype}' (unexpected '{tokens[pos]}')")
+        return data_type
+
     def to_spark_schema(self, schema):#: list[list[str]]):
         """ Creates a spark schema from a schema specified in the OEA schema format. 
             Example:
@@ -92,45 +427,133 @@ class OEA:
                                     ['CreateDate','timestamp','no-op'],
                                     ['LastModifiedDate','timestamp','no-op']]
             to_spark_schema(schemas['Person'])
+            The type names are validated (see to_spark_type) and the resulting spark schema is cached, so each OEA schema is only parsed once.
         """
-        fields = []
-        for col_name, dtype, op in schema:
-            fields.append(StructField(col_name, globals()[dtype.lower().capitalize() + "Type"](), True))
-        spark_schema = StructType(fields)
-        return spark_schema
+        key = tuple([(col_name, dtype) for col_name, dtype, op in schema])
+        if key not in self.spark_schemas:
+            fields = []
+            for col_name, dtype, op in schema:
+                try:
+                    fields.append(StructField(col_name, self.to_spark_type(dtype), True))
+                except ValueError as e:
+                    raise ValueError(f"Column '{col_name}': {e}")
+            self.spark_schemas[key] = StructType(fields)
+        return self.spark_schemas[key]
 
-    def pseudonymize(self, df, schema): #: list[list[str]]):
+    @_instrumented('pseudonymize', target_arg=None)
+    def pseudonymize(self, df, schema, pseudonyms=None): #: list[list[str]]):
         """ Performs pseudonymization of the given dataframe based on the provided schema.
             For example, if the given df is for an entity called person, 
             2 dataframes will be returned, one called person that has hashed ids and masked fields, 
             and one called person_lookup that contains the original person_id, person_id_pseudo,
-            and the non-masked values for columns marked to be masked."""
-        
-        df_pseudo = df_lookup = df
-
+            and the non-masked values for columns marked to be masked.
+            Each hashed column is computed once in a projection shared by both dataframes, and each dataframe is then built with a single select
+            (which also fixes the column names), rather than chaining a withColumn per column, to keep the query plans flat for wide tables.
+            If a pseudonyms df is given (see update_pseudonym_cache), the pseudonyms are looked up in it rather than hashed again
+            (it's deduplicated by value first, so that the lookups can't duplicate rows), and the values that are not in it are hashed as usual."""
+        ops = {}
         for col_name, dtype, op in schema:
+            ops[col_name.lower()] = (col_name, op) # column names are resolved case-insensitively, like withColumn and drop
+
+        hashed_cols = [col_name for col_name, op in ops.values() if op in ('hash', 'h', 'hash-no-lookup', 'hnl')]
+        self.record(hashed_columns=len(hashed_cols), pseudonym_lookup=pseudonyms is not None) # the dfs are lazy, so the hashing itself is timed by the span of the write
+        if pseudonyms is None:
+            df_hashed = df.select([F.col(col) for col in df.columns] + [F.sha2(F.concat(F.col(col_name), F.lit(self.salt)), 256).alias(col_name + "_pseudonym") for col_name in hashed_cols])
+        else:
+            df_hashed = df
+            pseudonyms = pseudonyms.dropDuplicates(['value'])
+            for n, col_name in enumerate(hashed_cols):
+                df_pseudonyms = pseudonyms.select(F.col('value').alias(f"_value{n}"), F.col('pseudonym').alias(f"_pseudonym{n}"))
+                df_hashed = df_hashed.join(df_pseudonyms, F.col(col_name).cast('string') == F.col(f"_value{n}"), 'left')
+                hashed = F.coalesce(F.col(f"_pseudonym{n}"), F.sha2(F.concat(F.col(col_name), F.lit(self.salt)), 256))
+                df_hashed = df_hashed.withColumn(col_name + "_pseudonym", hashed).drop(f"_value{n}", f"_pseudonym{n}")
+
+        pseudo_cols = []
+        lookup_cols = []
+        for col in df.columns:
+            col_name, op = ops.get(col.lower(), (col, None))
             if op == "hash-no-lookup" or op == "hnl":
                 # This means that the lookup can be performed against a different table so no lookup is needed.
-                df_pseudo = df_pseudo.withColumn(col_name, F.sha2(F.concat(F.col(col_name), F.lit(self.salt)), 256)).withColumnRenamed(col_name, col_name + "_pseudonym")
-                df_lookup = df_lookup.drop(col_name)           
+                pseudo_cols.append(col_name + "_pseudonym")
             elif op == "hash" or op == 'h':
-                df_pseudo = df_pseudo.withColumn(col_name, F.sha2(F.concat(F.col(col_name), F.lit(self.salt)), 256)).withColumnRenamed(col_name, col_name + "_pseudonym")
-                df_lookup = df_lookup.withColumn(col_name + "_pseudonym", F.sha2(F.concat(F.col(col_name), F.lit(self.salt)), 256))
+                pseudo_cols.append(col_name + "_pseudonym")
+                lookup_cols.append(col)
             elif op == "mask" or op == 'm':
-                df_pseudo = df_pseudo.withColumn(col_name, F.lit('*'))
+                pseudo_cols.append((col_name, F.lit('*')))
+                lookup_cols.append(col)
             elif op == "no-op" or op == 'x':
-                df_lookup = df_lookup.drop(col_name)
-
-        df_pseudo = self.fix_column_names(df_pseudo)
-        df_lookup = self.fix_column_names(df_lookup)
+                pseudo_cols.append(col)
+            else:
+                pseudo_cols.append(col)
+                lookup_cols.append(col)
+        # the lookup keeps the original values and gets the pseudonyms appended at the end
+        lookup_cols += [col_name + "_pseudonym" for col_name, op in ops.values() if op in ('hash', 'h')]
 
+        df_pseudo = df_hashed.select(self._select_with_valid_names(pseudo_cols))
+        df_lookup = df_hashed.select(self._select_with_valid_names(lookup_cols))
         return (df_pseudo, df_lookup)
 
+    def _salt_version(self):
+        """ Identifies the salt the pseudonyms were hashed with, without storing the salt itself. """
+        return hashlib.sha256(self.salt.encode('utf-8')).hexdigest()[:16]
+
+    @_instrumented('update_pseudonym_cache', target_arg=2)
+    def update_pseudonym_cache(self, df, schema, cache_path):
+        """ Hashes the values of the hashed columns (per the given schema) that are not yet in the pseudonym cache at cache_path, and adds them to it.
+            The cache is a delta table of (value, salt_version, pseudonym) shared by the entities of a module, so values are only hashed once across runs.
+            New entries are added with a merge on (value, salt_version) rather than an append, so concurrent updates of the cache can't add the same entry twice
+            (delta fails one of two conflicting merges instead).
+            Returns a df of the (value, pseudonym) entries for the values in the given df, to pass to pseudonymize, or None if there are no hashed columns.
+        """
+        values = self._get_hashed_values(df, schema)
+        if values is None: return None
+        salt_version = self._salt_version()
+        if DeltaTable.isDeltaTable(spark, cache_path):
+            cached = spark.read.format('delta').load(cache_path).where(F.col('salt_version') == salt_version)
+            new_pseudonyms = values.join(cached, 'value', 'left_anti')
+            new_pseudonyms = new_pseudonyms.select('value', F.lit(salt_version).alias('salt_version'), F.sha2(F.concat(F.col('value'), F.lit(self.salt)), 256).alias('pseudonym'))
+            condition = f"cache.salt_version = '{salt_version}' and cache.value = updates.value" # the salt_version literal limits the merge to the current salt's partition
+            DeltaTable.forPath(spark, cache_path).alias('cache').merge(new_pseudonyms.alias('updates'), condition).whenNotMatchedInsertAll().execute()
+            self.record(rows_out=int(self._get_last_operation_metrics(cache_path).get('numTargetRowsInserted', 0))) # the number of newly hashed values
+        else:
+            new_pseudonyms = values.select('value', F.lit(salt_version).alias('salt_version'), F.sha2(F.concat(F.col('value'), F.lit(self.salt)), 256).alias('pseudonym'))
+            new_pseudonyms.write.format('delta').partitionBy('salt_version').save(cache_path) # fails (rather than appending) if another writer created the cache first
+            self.record(rows_out=int(self._get_last_operation_metrics(cache_path).get('numOutputRows', 0)))
+        return self.get_pseudonyms(df, schema, cache_path)
+
+    def get_pseudonyms(self, df, schema, cache_path):
+        """ Returns a df of the (value, pseudonym) entries in the pseudonym cache at cache_path for the values of the hashed columns of the given df (per the given schema),
+            without updating the cache (see update_pseudonym_cache), or None if there are no hashed columns or no cache yet.
+            Only the entries for the incoming values are returned, so that pseudonymize doesn't join each hashed column against the whole cache.
+        """
+        values = self._get_hashed_values(df, schema)
+        if values is None or not DeltaTable.isDeltaTable(spark, cache_path): return None
+        cached = spark.read.format('delta').load(cache_path).where(F.col('salt_version') == self._salt_version()).select('value', 'pseudonym')
+        return cached.join(values, 'value', 'left_semi')
+
+    def _get_hashed_values(self, df, schema):
+        """ Returns a df with the distinct (non-null) values of the hashed columns of the given df as strings, or None if the schema has no hashed columns. """
+        hashed_cols = [col_name for col_name, dtype, op in schema if op in ('hash', 'h', 'hash-no-lookup', 'hnl')]
+        if not hashed_cols: return None
+        values = None
+        for col_name in hashed_cols:
+            col_values = df.select(F.col(col_name).cast('string').alias('value')).where(F.col('value').isNotNull())
+            values = col_values if values is None else values.union(col_values)
+        return values.distinct()
+
+    def _select_with_valid_names(self, cols):
+        """ Returns the given columns (names, or (name, column expression) tuples) aliased with valid Parquet column names. """
+        select = []
+        for col in cols:
+            if isinstance(col, str): col = (col, F.col(col))
+            select.append(col[1].alias(self._valid_column_name(col[0])))
+        return select
+
     # Returns true if the path exists
     def path_exists(self, path):
         tableExists = False
         try:
-            items = mssparkutils.fs.ls(path)
+            items = self._ls(path)
             tableExists = True
         except Exception as e:
             # This Exception comes as a generic Py4JJavaError that occurs when the path specified is not found.
@@ -141,7 +564,7 @@ class OEA:
         folders = []
         files = []
         try:
-            items = mssparkutils.fs.ls(path)
+            items = self._ls(path)
             for item in items:
                 if item.isFile:
                     files.append(item.name)
@@ -151,18 +574,60 @@ class OEA:
             logger.warning("[OEA] Could not peform ls on specified path: " + path + "\nThis may be because the path does not exist.")
         return (folders, files)
 
-    def print_stage(self, path):
-        print(path)
-        folders = self.get_folders(path)
-        for folder_name in folders:
-            entities = self.get_folders(path + '/' + folder_name)
-            print(f"{folder_name}: {entities}")
+    def _ls(self, path):
+        """ Returns mssparkutils.fs.ls(path), reusing the listing if it was made less than listing_cache_ttl seconds ago. """
+        if self.listing_cache_ttl > 0:
+            cached = self.listing_cache.get(path)
+            if cached and time.time() - cached[0] < self.listing_cache_ttl: return cached[1]
+        items = mssparkutils.fs.ls(path)
+        if self.listing_cache_ttl > 0: self.listing_cache[path] = (time.time(), items)
+        return items
+
+    def clear_listing_cache(self, path=None):
+        """ Clears the cached listings of the given path and everything under it (or all cached listings if no path is given). """
+        if path is None: self.listing_cache = {}
+        else: self.listing_cache = {p: v for p, v in self.listing_cache.items() if not (p == path or p.startswith(path.rstrip('/') + '/'))}
+
+    def list_tree(self, path, max_depth=None, include_files=True, skip_hidden=False):
+        """ Walks the folder tree under the given path, listing up to listing_parallelism folders concurrently, and returns an inventory of its folders and files.
+            Each entry is a dict like: {'path': ..., 'name': 'Person', 'parent': <path of the folder it's in>, 'depth': 1, 'is_dir': True, 'size': 0, 'modify_time': ...}
+            max_depth limits how many levels are walked (1 only lists the given path), and skip_hidden skips the files and folders
+            whose names start with '_' or '.' (eg, _SUCCESS or _delta_log), as spark does when loading a folder.
+            Ex: oea.list_tree(oea.stage2np, max_depth=2, include_files=False)
+        """
+        inventory = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.listing_parallelism) as executor:
+            pending = {executor.submit(self._ls, path): (path, 0)}
+            while pending:
+                done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    folder_path, depth = pending.pop(future)
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        logger.warning("[OEA] Could not list the specified path: " + folder_path + "\nThis may be because the path does not exist.")
+                        continue
+                    for item in items:
+                        if skip_hidden and (item.name.startswith('_') or item.name.startswith('.')): continue
+                        entry = {'path': item.path, 'name': item.name, 'parent': folder_path, 'depth': depth + 1, 'is_dir': item.isDir, 'size': item.size, 'modify_time': getattr(item, 'modifyTime', None)}
+                        if item.isDir:
+                            inventory.append(entry)
+                            if max_depth is None or depth + 1 < max_depth: pending[executor.submit(self._ls, item.path)] = (item.path, depth + 1)
+                        elif include_files:
+                            inventory.append(entry)
+        return sorted(inventory, key=lambda entry: entry['path'])
+
+    def get_files(self, path, recursive=True):
+        """ Returns the files (as list_tree entries) found in the given path, including those in its subfolders unless recursive is False.
+            Files and folders whose names start with '_' or '.' (eg, _SUCCESS) are skipped, as they are when spark loads a folder.
+        """
+        return [entry for entry in self.list_tree(path, None if recursive else 1, skip_hidden=True) if not entry['is_dir']]
 
     # Return the list of folders found in the given path.
     def get_folders(self, path):
         dirs = []
         try:
-            items = mssparkutils.fs.ls(path)
+            items = self._ls(path)
             for item in items:
                 #print(item.name, item.isDir, item.isFile, item.path, item.size)
                 if item.isDir:
@@ -171,8 +636,102 @@ class OEA:
             logger.warning("[OEA] Could not get list of folders in specified path: " + path + "\nThis may be because the path does not exist.")
         return dirs
 
+    def get_delta_tables(self, path, max_depth=2):
+        """ Returns the paths of the delta tables found in the given path, looking into subfolders up to max_depth levels deep (eg, stage2np/m365/Person). """
+        if DeltaTable.isDeltaTable(spark, path): return [path]
+        tables = []
+        if max_depth > 0:
+            for folder_name in self.get_folders(path):
+                tables += self.get_delta_tables(f"{path}/{folder_name}", max_depth - 1)
+        return tables
+
+    @_instrumented('optimize')
+    def optimize(self, path, zorder_columns=None, target_file_size=None, vacuum_retention_hours=None, max_depth=2):
+        """ Compacts the small files of every delta table found in the given path (eg, a whole stage like oea.stage2np, or a single table).
+            zorder_columns (eg, ['ActorId', 'SISClassId']) are used to Z-order the tables that have them (other than their partition columns), or their hashed
+            version (eg, ActorId_pseudonym in stage2p); the columns a table doesn't have are logged and skipped for that table.
+            target_file_size (in bytes) sets the size of the compacted files (for this call only), and vacuum_retention_hours removes the files no longer referenced
+            by the versions of the table within that retention window.
+            OPTIMIZE and Z-ordering need Delta 2.0+ (the Spark 3.1 pools provisioned by the setup scripts have Delta 1.0). On older versions the tables are compacted
+            by rewriting them (see _compact_table), and asking for zorder_columns raises a NotImplementedError.
+            A vacuum_retention_hours below 168 (Delta's default minimum of 7 days) raises a ValueError unless spark.databricks.delta.retentionDurationCheck.enabled
+            has been set to false, since it can remove files still needed by running readers or by time travel.
+            Returns a list with the number of files in each table before and after the maintenance.
+            Ex: oea.optimize(oea.stage2np, zorder_columns=['ActorId'], vacuum_retention_hours=168)
+        """
+        supports_optimize = hasattr(DeltaTable, 'optimize')
+        if zorder_columns and not supports_optimize:
+            raise NotImplementedError(f"Z-ordering needs Delta 2.0 or later, which has DeltaTable.optimize; this Spark pool's Delta version doesn't. Call optimize without zorder_columns to compact the tables.")
+        if vacuum_retention_hours is not None and vacuum_retention_hours < 168 and spark.conf.get('spark.databricks.delta.retentionDurationCheck.enabled', 'true').lower() != 'false':
+            raise ValueError(f"vacuum_retention_hours={vacuum_retention_hours} is below Delta's minimum retention of 168 hours. "
+                             "Set spark.databricks.delta.retentionDurationCheck.enabled to false first if no reader needs the older versions.")
+        if not supports_optimize:
+            return [self._optimize_table(table_path, None, vacuum_retention_hours, target_file_size) for table_path in self.get_delta_tables(path, max_depth)]
+
+        previous_file_size = spark.conf.get('spark.databricks.delta.optimize.maxFileSize', None)
+        if target_file_size: spark.conf.set('spark.databricks.delta.optimize.maxFileSize', str(target_file_size))
+        try:
+            report = []
+            for table_path in self.get_delta_tables(path, max_depth):
+                report.append(self._optimize_table(table_path, zorder_columns, vacuum_retention_hours, target_file_size))
+            return report
+        finally:
+            # the setting is session-wide, so it's put back as it was
+            if target_file_size:
+                if previous_file_size is None: spark.conf.unset('spark.databricks.delta.optimize.maxFileSize')
+                else: spark.conf.set('spark.databricks.delta.optimize.maxFileSize', previous_file_size)
+
+    @_instrumented('optimize_table')
+    def _optimize_table(self, table_path, zorder_columns, vacuum_retention_hours, target_file_size=None):
+        start = time.time()
+        delta_table = DeltaTable.forPath(spark, table_path)
+        detail = spark.sql(f"DESCRIBE DETAIL delta.`{table_path}`").collect()[0]
+        files_before = detail['numFiles']
+        columns = []
+        if hasattr(delta_table, 'optimize'):
+            table_columns = spark.read.format('delta').load(table_path).columns
+            for col in (zorder_columns or []):
+                if col not in table_columns and col + '_pseudonym' in table_columns: col += '_pseudonym'
+                if col in table_columns and col not in detail['partitionColumns']: columns.append(col)
+                else: logger.info(f"[OEA] Not Z-ordering {table_path} by {col}, as it's not a (non-partition) column of the table")
+            if columns: delta_table.optimize().executeZOrderBy(columns)
+            else: delta_table.optimize().executeCompaction()
+        else:
+            self._compact_table(table_path, detail, target_file_size or DEFAULT_TARGET_FILE_SIZE)
+        if vacuum_retention_hours is not None: delta_table.vacuum(vacuum_retention_hours)
+        result = {'table': table_path, 'files_before': files_before, 'files_after': self._get_num_files(table_path), 'zorder_columns': columns, 'seconds': round(time.time() - start, 1)}
+        logger.info(f"[OEA] Optimized {table_path}: {result['files_before']} -> {result['files_after']} files")
+        self.record(files_before=result['files_before'], files_after=result['files_after'])
+        return result
+
+    def _compact_table(self, table_path, detail, target_file_size):
+        """ Compacts the delta table at the given path (whose DESCRIBE DETAIL row is given) on Delta versions without OPTIMIZE, by rewriting it into files
+            of about target_file_size bytes. The rewrite is committed with dataChange=false, so streams reading the table don't see it as new data.
+            A partitioned table is rewritten one partition at a time (with replaceWhere), and only the partitions that have more files than needed are rewritten;
+            the size of a partition is estimated from its share of the table's rows.
+        """
+        df = spark.read.format('delta').load(table_path)
+        partition_columns = detail['partitionColumns']
+        if not partition_columns:
+            num_files = max(1, math.ceil(detail['sizeInBytes'] / target_file_size))
+            if detail['numFiles'] > num_files:
+                df.repartition(num_files).write.format('delta').mode('overwrite').option('dataChange', 'false').save(table_path)
+            return
+
+        partitions = df.groupBy([F.col(f"`{col}`") for col in partition_columns]).agg(F.count(F.lit(1)).alias('_rows'), F.countDistinct(F.input_file_name()).alias('_files')).collect()
+        total_rows = sum([partition['_rows'] for partition in partitions]) or 1
+        for partition in partitions:
+            num_files = max(1, math.ceil(detail['sizeInBytes'] * partition['_rows'] / total_rows / target_file_size))
+            if partition['_files'] <= num_files: continue
+            predicate = ' and '.join([_partition_value_predicate(col, partition[col]) for col in partition_columns])
+            df.where(predicate).repartition(num_files).write.format('delta').mode('overwrite').option('dataChange', 'false').option('replaceWhere', predicate).save(table_path)
+
+    def _get_num_files(self, table_path):
+        return spark.sql(f"DESCRIBE DETAIL delta.`{table_path}`").collect()[0]['numFiles']
+
     # Remove a folder if it exists (defaults to use of recursive removal).
     def rm_if_exists(self, path, recursive_remove=True):
+        self.clear_listing_cache(path)
         try:
             mssparkutils.fs.rm(path, recursive_remove)
         except Exception as e:
@@ -193,29 +752,83 @@ class OEA:
         m = re.match(r".*:\/\/stage(?P<stage_num>\d+)[n]?[p]?@[^/]+\/(?P<ss>[^/]+)", path)
         return m.groupdict()
     
-    def create_db(self, source_path, source_format='DELTA'):
+    @_instrumented('create_db')
+    def create_db(self, source_path, source_format='DELTA', parallelism=8):
         """ Creates a spark db based on the given path (assumes that every folder in the given path is a table).
+            The tables are registered concurrently (up to the given parallelism). Existing tables that already point to the same location with the same format
+            are skipped, and the ones that don't are replaced, unless they point to a different stage: stage2p and stage2np share the s2 db, so a table registered
+            from stage2p is never replaced by the stage2np folder of the same name (it's skipped with a warning). Returns what was done for each table and how long it took, eg: {'Person': {'action': 'created', 'seconds': 1.4}}
             Note that a spark db that points to source data in the delta format can't be queried via SQL serverless pool. More info here: https://docs.microsoft.com/en-us/azure/synapse-analytics/sql/resources-self-help-sql-on-demand#delta-lake
         """
         source_info = self.parse_source_path(source_path)
         db_name = f"s{source_info['stage_num']}_{source_info['ss']}"
         spark.sql(f"CREATE DATABASE IF NOT EXISTS {db_name}")
-        dirs = self.get_folders(source_path)
-        for table_name in dirs:
-            spark.sql(f"create table if not exists {db_name}.{table_name} using {source_format} location '{source_path}/{table_name}'")
-        result = "Database created: " + db_name
-        logger.info(result)
-        return result
+        existing_tables = set([row['tableName'].lower() for row in spark.sql(f"SHOW TABLES FROM {db_name}").collect()])
+        # folders like _pseudonyms hold framework data rather than tables
+        table_names = [table_name for table_name in self.get_folders(source_path) if not table_name.startswith('_')]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+            results = executor.map(lambda table_name: self._register_table(db_name, table_name, f"{source_path}/{table_name}", source_format, table_name.lower() in existing_tables), table_names)
+            timings = dict(zip(table_names, results))
+        actions = collections.Counter([timing['action'] for timing in timings.values()])
+        logger.info(f"Database created: {db_name} (tables created: {actions['created']}, replaced: {actions['replaced']}, skipped: {actions['skipped']})")
+        return timings
+
+    def _register_table(self, db_name, table_name, location, source_format, exists):
+        start = time.time()
+        action = 'created'
+        if exists:
+            detail = self._describe_table(db_name, table_name)
+            existing_location = detail.get('Location', '').rstrip('/')
+            if existing_location == location.rstrip('/') and detail.get('Provider', '').lower() == source_format.lower():
+                action = 'skipped'
+            elif self._get_stage_root(existing_location) != self._get_stage_root(location):
+                logger.warning(f"[OEA] Not registering {location} as {db_name}.{table_name}, which already points to a different stage: {existing_location}")
+                action = 'skipped'
+            else:
+                spark.sql(f"DROP TABLE {db_name}.{table_name}") # the tables are external, so this leaves the data in place
+                action = 'replaced'
+        if action != 'skipped':
+            spark.sql(f"create table if not exists {db_name}.{table_name} using {source_format} location '{location}'")
+        # delta tables track their own partitions, but the partitions of a parquet table have to be registered in the metastore (also picks up new partitions of existing tables)
+        if source_format.upper() == 'PARQUET' and any(col.isPartition for col in spark.catalog.listColumns(table_name, db_name)):
+            spark.sql(f"MSCK REPAIR TABLE {db_name}.{table_name}")
+        return {'action': action, 'seconds': round(time.time() - start, 2)}
 
-    def drop_db(self, db_name):
-        """ Drop all tables in a db, then drop the db. """
-        df = spark.sql('SHOW TABLES FROM ' + db_name)
-        for row in df.rdd.collect():
-            spark.sql(f"DROP TABLE IF EXISTS {db_name}.{row['tableName']}")
-        spark.sql(f"DROP DATABASE IF EXISTS {db_name}")
+    def _get_stage_root(self, path):
+        """ Returns the root of the stage (container) the path is in, eg: 'abfss://stage2p@stoeacisd3ggimpl3.dfs.core.windows.net' """
+        m = re.match(r"[^:/]+:\/\/[^/]+", path)
+        return m.group(0).lower() if m else ''
+
+    def _describe_table(self, db_name, table_name):
+        """ Returns the details of the table (eg, 'Location', 'Provider') as a dict. """
+        return {row['col_name']: row['data_type'] for row in spark.sql(f"DESCRIBE TABLE EXTENDED {db_name}.{table_name}").collect()}
+
+    @_instrumented('drop_db')
+    def drop_db(self, db_name, cascade=True, delete_data=False, parallelism=8):
+        """ Drop all tables in a db, then drop the db.
+            With cascade (the default) the db and its tables are dropped with a single DROP DATABASE ... CASCADE, otherwise the tables are dropped concurrently
+            (up to the given parallelism) before the db. With delete_data=True, the folders the tables point to are deleted as well, concurrently.
+            Ex: oea.drop_db('s2_m365', delete_data=True)
+        """
+        if spark.sql(f"SHOW DATABASES LIKE '{db_name}'").count() == 0:
+            logger.info("Database does not exist: " + db_name)
+            return "Database does not exist: " + db_name
+        table_names = []
+        if delete_data or not cascade:
+            table_names = [row['tableName'] for row in spark.sql('SHOW TABLES FROM ' + db_name).collect() if not row['isTemporary']]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+            locations = []
+            if delete_data: locations = [detail.get('Location') for detail in executor.map(lambda table_name: self._describe_table(db_name, table_name), table_names)]
+            if cascade:
+                spark.sql(f"DROP DATABASE IF EXISTS {db_name} CASCADE")
+            else:
+                list(executor.map(lambda table_name: spark.sql(f"DROP TABLE IF EXISTS {db_name}.{table_name}"), table_names))
+                spark.sql(f"DROP DATABASE IF EXISTS {db_name}")
+            list(executor.map(self.rm_if_exists, [location for location in locations if location]))
         result = "Database dropped: " + db_name
+        if delete_data: result += f" (deleted the data of {len(locations)} tables)"
         logger.info(result)
-        return result         
+        return result
 
     # List installed packages
     def list_packages(self):
@@ -225,31 +838,70 @@ class OEA:
 
     def print_schema_starter(self, entity_name, df):
         """ Prints a starter schema that can be modified as needed when developing the oea schema for a new module. """
-        st = f"self.schemas['{entity_name}'] = ["
-        for col in df.schema:
-            st += f"['{col.name}', '{str(col.dataType)[:-4].lower()}', 'no-op'],\n\t\t\t\t\t\t\t\t\t"
-        return st[:-11] + ']'
+        return self.format_schema_starter(entity_name, [[col.name, str(col.dataType)[:-4].lower(), 'no-op'] for col in df.schema])
+
+    def format_schema_starter(self, entity_name, schema):
+        """ Formats the given schema as the python code that defines it in a module (eg, "self.schemas['Person'] = [['Id', 'string', 'hash'], ...]") """
+        return f"self.schemas['{entity_name}'] = [" + ",\n\t\t\t\t\t\t\t\t\t".join([f"['{col_name}', '{dtype}', '{op}']" for col_name, dtype, op in schema]) + ']'
+
+    def infer_schema_starter(self, path, max_files=20, max_bytes=65536, format=None, header=True):
+        """ Infers a starter OEA schema from a sample of the files in the given path (eg, a stage1np entity folder), instead of a full spark inference scan.
+            Up to max_files files are sampled, picked in turn from each subfolder (so eg, each date folder of an activity feed is represented), and only the first max_bytes
+            of each are read (see load_samples). The column types are widened across the samples (eg, integer in one file and double in another becomes double),
+            and the columns that look like identifiers of people (eg, 'StudentId', 'ActorId', 'email') are marked as 'hash' candidates.
+            Ex: print(oea.format_schema_starter('Person', oea.infer_schema_starter(oea.stage1np + '/m365/DIPData/Roster/Person', header=False)))
+        """
+        files_by_folder = collections.OrderedDict()
+        for f in self.get_files(path):
+            files_by_folder.setdefault(f['parent'], []).append(f)
+        sample_files = []
+        while len(sample_files) < max_files and any(files_by_folder.values()):
+            for files in files_by_folder.values():
+                if files and len(sample_files) < max_files: sample_files.append(files.pop(0))
+        samples = self.load_samples([f['path'][len(path) + 1:] for f in sample_files], format, max_bytes, header=header, stage=path)
+        samples = [pdf for pdf in samples.values() if pdf is not None]
+        if not samples: raise ValueError(f"Could not load any sample from: {path}")
+
+        types = collections.OrderedDict()
+        for pdf in samples:
+            for col_name in pdf.columns:
+                types[str(col_name)] = _widen_oea_types(types.get(str(col_name)), _infer_oea_type(pdf[col_name]))
+        schema = []
+        for col_name, dtype in types.items():
+            values = pd.concat([pdf[col] for pdf in samples for col in pdf.columns if str(col) == col_name])
+            schema.append([col_name, dtype or 'string', 'hash' if _is_identifier_column(col_name, values) else 'no-op'])
+        return schema
 
-    def write_rows_as_csv(data, folder, filename, container=None):
+    def write_rows_as_csv(self, data, folder, filename, container=None, max_driver_rows=100000):
         """ Writes a dictionary as a csv to the specified location. This is helpful when creating test data sets and landing them in stage1np.
             data = [{'id':'1','fname':'John'}, {'id':'1','fname':'Jane'}]
+            Up to max_driver_rows rows are rendered on the driver and written as a single file. Larger data sets are converted to a spark df (with a string column
+            for each key found in the rows) and written in parallel by the executors, as a folder (with the given filename) of csv part files, which spark reads
+            like a single csv file (and load_sample reads the first part of). Whatever is at the path already (a file or a folder) is replaced.
         """
         if container == None: container = self.stage1np
-        pdf = pd.DataFrame(data)
-        mssparkutils.fs.put(f"{container}/{folder}/{filename}", pdf.to_csv(index=False), True) # True indicates overwrite mode  
+        path = f"{container}/{folder}/{filename}"
+        self.rm_if_exists(path) # the path may hold the other layout (eg, a folder from an earlier, larger write), which can't be overwritten by the new one
+        if len(data) <= max_driver_rows:
+            pdf = pd.DataFrame(data)
+            mssparkutils.fs.put(path, pdf.to_csv(index=False), True) # True indicates overwrite mode  
+        else:
+            columns = list(dict.fromkeys([key for row in data for key in row])) # every key, in the order they first appear (like pd.DataFrame does)
+            schema = StructType([StructField(col_name, StringType(), True) for col_name in columns])
+            rows = spark.sparkContext.parallelize(data).map(lambda row: [None if row.get(col_name) is None else str(row[col_name]) for col_name in columns])
+            spark.createDataFrame(rows, schema).write.option('header', True).csv(path)
 
-    def write_rowset_as_csv(data, folder, container=None):
+    def write_rowset_as_csv(self, data, folder, container=None, max_driver_rows=100000):
         """ Writes out as csv rows the passed in data. The inbound data should be in a format like this:
             data = { 'students':[{'id':'1','fname':'John'}], 'courses':[{'id':'31', 'name':'Math'}] }
+            (see write_rows_as_csv for how large row sets are written)
         """
-        if container == None: container = self.stage1np
         for entity_name, value in data.items():
-            pdf = pd.DataFrame(value)
-            mssparkutils.fs.put(f"{container}/{folder}/{entity_name}.csv", pdf.to_csv(index=False), True) # True indicates overwrite mode  
+            self.write_rows_as_csv(value, folder, f"{entity_name}.csv", container, max_driver_rows)
 
 class BaseOEAModule:
     """ Provides data processing methods for Contoso SIS data (the student information system for the fictional Contoso school district).  """
-    def __init__(self, oea, source_folder, pseudonymize = True):
+    def __init__(self, oea, source_folder, pseudonymize = True, pseudonym_cache = False):
         self.pseudonymize = pseudonymize
         self.oea = oea
         self.stage1np = f"{oea.stage1np}/{source_folder}"
@@ -258,20 +910,187 @@ class BaseOEAModule:
         self.stage3np = f"{oea.stage3np}/{source_folder}"
         self.stage3p = f"{oea.stage3p}/{source_folder}"
         self.module_path = f"{oea.framework_path}/modules/{source_folder}"
+        # With pseudonym_cache=True, the pseudonyms hashed in earlier runs are kept here so that only new values are hashed (see OEA.update_pseudonym_cache).
+        # This pays off for large, mostly unchanged sources; otherwise hashing in a single projection (see OEA.pseudonymize) is cheaper than the joins with the cache.
+        self.pseudonym_cache_path = f"{self.stage2np}/_pseudonyms" if pseudonym_cache else None
         self.schemas = {}
+        # Optional partitioning of the stage2 tables, per entity, as a list of [partition column, spark sql expression that derives it].
+        # Ex: self.partitions['studentattendance'] = [['attendance_day', 'to_date(attendance_date)']]
+        self.partitions = {}
    
-    def _process_entity_from_stage1(self, entity_name, format='csv', write_mode='overwrite', header='true'):
-        spark_schema = self.oea.to_spark_schema(self.schemas[entity_name])
-        df = spark.read.format(format).load(f"{self.stage1np}/{entity_name}", header=header, schema=spark_schema)
+    @_instrumented('process_entity')
+    def _process_entity_from_stage1(self, entity_name, format='csv', write_mode='overwrite', header='true', incremental=False, key_columns=None, update_pseudonym_cache=True, loaded=None):
+        """ Loads the entity from stage1np, pseudonymizes it (if enabled) and writes it to stage2. Returns the number of rows written to stage2.
+            With incremental=True, only the stage1 files that were not processed in earlier runs are loaded (see _get_unprocessed_files),
+            and they're merged into stage2 by the given key_columns (updating the rows with matching keys), or appended if no key_columns are given.
+            With update_pseudonym_cache=False, the pseudonym cache (if enabled) is only read, eg when it was updated beforehand (see process_entities).
+            loaded is the (df, new_files) returned by an earlier call of _load_entity_from_stage1 with the same args, to process the same files without listing and loading them again.
+        """
+        df, new_files = loaded or self._load_entity_from_stage1(entity_name, format, header, incremental)
+        if incremental:
+            if not new_files:
+                logger.info(f"[OEA] No new stage1 files to process for {entity_name}")
+                return 0
+            self.oea.record(files_in=len(new_files), bytes_in=sum([f['size'] for f in new_files]))
+            write_mode = 'merge' if key_columns else 'append'
 
         if self.pseudonymize:
-            df_pseudo, df_lookup = self.oea.pseudonymize(df, self.schemas[entity_name])
-            df_pseudo.write.format('delta').mode(write_mode).save(f"{self.stage2p}/{entity_name}")
+            pseudonyms = None
+            if self.pseudonym_cache_path and update_pseudonym_cache: pseudonyms = self.oea.update_pseudonym_cache(df, self.schemas[entity_name], self.pseudonym_cache_path)
+            elif self.pseudonym_cache_path: pseudonyms = self.oea.get_pseudonyms(df, self.schemas[entity_name], self.pseudonym_cache_path)
+            df_pseudo, df_lookup = self.oea.pseudonymize(df, self.schemas[entity_name], pseudonyms)
+            df_pseudo = self._add_partition_columns(entity_name, df_pseudo)
+            rows_written = self._write_to_stage2(df_pseudo, f"{self.stage2p}/{entity_name}", write_mode, self._get_stage2_key_columns(entity_name, key_columns), self._get_partition_columns(entity_name))
             if len(df_lookup.columns) > 0:
-                df_lookup.write.format('delta').mode(write_mode).save(f"{self.stage2np}/{entity_name}_lookup")
+                if pseudonyms is None and not incremental: df_lookup.write.format('delta').mode(write_mode).save(f"{self.stage2np}/{entity_name}_lookup")
+                else: self._write_lookup(df_lookup, f"{self.stage2np}/{entity_name}_lookup", self.schemas[entity_name], 'append' if write_mode == 'merge' else write_mode)
+        else:
+            df = self._add_partition_columns(entity_name, self.oea.fix_column_names(df))
+            rows_written = self._write_to_stage2(df, f"{self.stage2np}/{entity_name}", write_mode, self._get_stage2_key_columns(entity_name, key_columns), self._get_partition_columns(entity_name))
+
+        if incremental: self._checkpoint_files(entity_name, new_files)
+        self.oea.record(rows_out=rows_written)
+        return rows_written
+
+    @_instrumented('load_stage1')
+    def _load_entity_from_stage1(self, entity_name, format='csv', header='true', incremental=False):
+        """ Loads the entity from stage1np and returns the df along with the files it was loaded from if incremental is True (the df is None if there are no new files). """
+        source_path = f"{self.stage1np}/{entity_name}"
+        new_files = None
+        if incremental:
+            new_files = self._get_unprocessed_files(entity_name)
+            if not new_files: return (None, new_files)
+            self.oea.record(files_in=len(new_files), bytes_in=sum([f['size'] for f in new_files]))
+            # basePath keeps the partition columns of subfolders (eg, date=2021-06-02) the same as when the whole folder is loaded
+            reader = spark.read.format(format).option('basePath', source_path)
+            source = [f['path'] for f in new_files]
         else:
-            df = self.oea.fix_column_names(df)   
-            df.write.format('delta').mode(write_mode).save(f"{self.stage2np}/{entity_name}")
+            reader = spark.read.format(format)
+            source = source_path
+
+        if format == 'parquet':
+            # parquet data is already typed (eg, when landed with DataGenUtil.ParquetWriter), so it's loaded as is rather than parsed with the schema
+            return (reader.load(source), new_files)
+        spark_schema = self.oea.to_spark_schema(self.schemas[entity_name])
+        return (reader.load(source, header=header, schema=spark_schema), new_files)
+
+    def _get_stage2_key_columns(self, entity_name, key_columns):
+        """ Returns the names the given key columns have in stage2 (eg, 'Id' becomes 'Id_pseudonym' if it's hashed). """
+        if not key_columns: return []
+        if isinstance(key_columns, str): key_columns = [key_columns]
+        ops = {col_name.lower(): op for col_name, dtype, op in self.schemas[entity_name]}
+        stage2_key_columns = []
+        for col_name in key_columns:
+            if self.pseudonymize and ops.get(col_name.lower()) in ('hash', 'h', 'hash-no-lookup', 'hnl'): col_name += "_pseudonym"
+            stage2_key_columns.append(self.oea._valid_column_name(col_name))
+        return stage2_key_columns
+
+    def _get_partition_columns(self, entity_name):
+        return [col_name for col_name, expression in self.partitions.get(entity_name, [])]
+
+    def _add_partition_columns(self, entity_name, df):
+        """ Adds the partition columns of the entity (see self.partitions) to the df, so that date-bounded queries only read the matching partitions. """
+        for col_name, expression in self.partitions.get(entity_name, []):
+            df = df.withColumn(col_name, F.expr(expression))
+        return df
+
+    @_instrumented('write_stage2', target_arg=1)
+    def _write_to_stage2(self, df, path, write_mode, key_columns, partition_columns=None):
+        """ Writes the df to the delta table at the given path, and returns the number of rows written.
+            In 'merge' mode, rows with matching key columns are updated and the other rows are inserted (see OEA.upsert).
+        """
+        if write_mode == 'merge':
+            metrics = self.oea.upsert(df, path, key_columns, partition_columns=partition_columns)
+            # the upsert records these on its own (nested) span, so they're set on this one too
+            self.oea.record(rows_in=metrics['source_rows'], rows_out=metrics['inserted'] + metrics['updated'], rows_deleted=metrics['deleted'])
+            return metrics['inserted'] + metrics['updated']
+        elif partition_columns:
+            # overwriteSchema allows an existing table to be rewritten with a different partitioning
+            writer = df.write.format('delta').mode(write_mode).partitionBy(*partition_columns)
+            if write_mode == 'overwrite': writer = writer.option('overwriteSchema', 'true')
+            writer.save(path)
+        else:
+            df.write.format('delta').mode(write_mode).save(path)
+        metrics = self.oea._get_last_operation_metrics(path)
+        self.oea.record(rows_in=int(metrics.get('numOutputRows', 0)), rows_out=int(metrics.get('numOutputRows', 0)), bytes_written=int(metrics.get('numOutputBytes', 0)),
+                        files_written=int(metrics.get('numFiles', 0)))
+        return int(metrics.get('numOutputRows', 0))
+
+    def process_entities(self, entity_names, parallelism=4, scheduler_pools=False, entity_kwargs=None, **kwargs):
+        """ Processes the given entities from stage1 to stage2 (see _process_entity_from_stage1, which is called with the given kwargs for every entity,
+            and with the kwargs in entity_kwargs for the entity they're keyed by, eg: entity_kwargs={'Person': {'key_columns': ['Id']}}),
+            submitting up to the given parallelism entities at a time so that small tables don't wait on each other.
+            The pseudonym cache (if enabled) is shared by the module's entities, so it's updated for each of them in turn before they're processed concurrently.
+            The dfs loaded for that are then reused to process the entities, but since they're not cached, the stage1 data is read twice (once for the cache and once to process it).
+            With scheduler_pools=True, each entity's jobs run in their own spark scheduler pool (named oea_<entity>), so that with the FAIR scheduler a large table doesn't hold up the others.
+            This needs pyspark's pinned thread mode (so that the pool set in a thread applies to that thread's jobs), which is the default from Spark 3.2;
+            on Spark 3.1 set the PYSPARK_PIN_THREAD environment variable to true before the session starts (eg, spark.yarn.appMasterEnv.PYSPARK_PIN_THREAD in the pool's spark config).
+            Returns the wall time and number of rows written for each entity, eg: {'Person': {'seconds': 12.1, 'rows_written': 1200}}
+            Ex: m365.process_entities(['Person', 'PersonIdentifier', 'Section'], format='csv', header='false')
+        """
+        if scheduler_pools and not _is_thread_pinned():
+            raise ValueError("scheduler_pools=True needs pyspark's pinned thread mode: set the PYSPARK_PIN_THREAD environment variable to true before the spark session starts.")
+        entity_kwargs = {entity_name: dict(kwargs, **(entity_kwargs or {}).get(entity_name, {})) for entity_name in entity_names}
+        if self.pseudonymize and self.pseudonym_cache_path:
+            for entity_name in entity_names:
+                load_kwargs = {key: value for key, value in entity_kwargs[entity_name].items() if key in ('format', 'header', 'incremental')}
+                df, new_files = self._load_entity_from_stage1(entity_name, **load_kwargs)
+                if df is not None: self.oea.update_pseudonym_cache(df, self.schemas[entity_name], self.pseudonym_cache_path)
+                entity_kwargs[entity_name]['loaded'] = (df, new_files)
+
+        def process(entity_name):
+            if scheduler_pools: spark.sparkContext.setLocalProperty('spark.scheduler.pool', f"oea_{entity_name}")
+            start = time.time()
+            try:
+                rows_written = self._process_entity_from_stage1(entity_name, update_pseudonym_cache=False, **entity_kwargs[entity_name])
+                return {'seconds': round(time.time() - start, 1), 'rows_written': rows_written}
+            except Exception as e:
+                logger.exception(f"[OEA] Failed to process {entity_name}")
+                return {'seconds': round(time.time() - start, 1), 'rows_written': None, 'error': str(e)}
+            finally:
+                if scheduler_pools: spark.sparkContext.setLocalProperty('spark.scheduler.pool', None)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+            report = dict(zip(entity_names, executor.map(process, entity_names)))
+        for entity_name, result in report.items():
+            logger.info(f"[OEA] Processed {entity_name}: {result}")
+        failed = [entity_name for entity_name, result in report.items() if 'error' in result]
+        if failed: raise RuntimeError(f"Failed to process entities: {failed} (see the log for details). Processing report: {report}")
+        return report
+
+    def _get_unprocessed_files(self, entity_name):
+        """ Returns the stage1 files of the entity that are not in its checkpoint (the manifest of the files already processed, kept in stage2np/_checkpoints).
+            A file that was overwritten since it was processed (ie, with a different size or modification time) is processed again.
+        """
+        files = self.oea.get_files(f"{self.stage1np}/{entity_name}")
+        checkpoint_path = f"{self.stage2np}/_checkpoints/{entity_name}"
+        if DeltaTable.isDeltaTable(spark, checkpoint_path):
+            processed = set([(row['path'], row['size'], row['modify_time']) for row in spark.read.format('delta').load(checkpoint_path).collect()])
+            files = [f for f in files if (f['path'], f['size'], f['modify_time'] or 0) not in processed]
+        return files
+
+    def _checkpoint_files(self, entity_name, files):
+        processed_time = datetime.datetime.now()
+        rows = [(f['path'], f['size'], f['modify_time'] or 0, processed_time) for f in files]
+        df = spark.createDataFrame(rows, 'path string, size long, modify_time long, processed_time timestamp')
+        df.write.format('delta').mode('append').save(f"{self.stage2np}/_checkpoints/{entity_name}")
+
+    @_instrumented('write_lookup', target_arg=1)
+    def _write_lookup(self, df_lookup, path, schema, write_mode):
+        """ Merges the lookup rows into the lookup table by their pseudonyms, rather than rewriting the whole table: rows with new pseudonyms are inserted,
+            and the rows already in the table are updated (eg, with a corrected name). Falls back to a plain write for a new table, or when there are no hashed columns to match on.
+        """
+        keys = [self.oea._valid_column_name(col_name + "_pseudonym") for col_name, dtype, op in schema if op in ('hash', 'h')]
+        if not keys or not DeltaTable.isDeltaTable(spark, path):
+            df_lookup.write.format('delta').mode(write_mode).save(path)
+            metrics = self.oea._get_last_operation_metrics(path)
+            self.oea.record(rows_out=int(metrics.get('numOutputRows', 0)), bytes_written=int(metrics.get('numOutputBytes', 0)), files_written=int(metrics.get('numFiles', 0)))
+            return
+        condition = ' and '.join([f"lookup.`{key}` <=> updates.`{key}`" for key in keys])
+        DeltaTable.forPath(spark, path).alias('lookup').merge(df_lookup.dropDuplicates(keys).alias('updates'), condition).whenMatchedUpdateAll().whenNotMatchedInsertAll().execute()
+        metrics = self.oea._get_last_operation_metrics(path)
+        self.oea.record(rows_in=int(metrics.get('numSourceRows', 0)), rows_out=int(metrics.get('numTargetRowsInserted', 0)) + int(metrics.get('numTargetRowsUpdated', 0)),
+                        files_written=int(metrics.get('numTargetFilesAdded', 0)))
 
     def delete_stage1(self):
         self.oea.rm_if_exists(self.stage1np)
@@ -301,24 +1120,121 @@ class BaseOEAModule:
         mssparkutils.fs.cp(self.module_path + '/test_data', self.stage1np, True)
     
 class DataLakeWriter:
-    def __init__(self, root_destination):
+    """ Appends data to files in the data lake. Writes are collected per path and appended in blocks of at least flush_size characters
+        (or when flush() or close() is called), instead of making one storage call per write. If more than max_buffered_size characters are
+        buffered across all paths, the largest buffer is appended right away.
+        Call close(), or use the writer in a with block, to append the data that is still buffered (the data generators' generate_data flushes the writer it's given when it's done).
+        fs is the file system api to use and defaults to mssparkutils.fs; any object with the same append(path, content, createFileIfNotExists) method
+        can be passed instead (eg, DataGenUtil.LocalFs to run against the local file system).
+        Note: this class is also defined in DataGenUtil.py (OEA.py is %run into notebooks, where DataGenUtil isn't available, and DataGenUtil has to run without pyspark),
+        so any change made here must be made to the copy in DataGenUtil.py too.
+    """
+    def __init__(self, root_destination, flush_size=4*1024*1024, max_buffered_size=64*1024*1024, fs=None):
+        if fs is None: fs = mssparkutils.fs
         self.root_destination = root_destination
+        self.flush_size = flush_size
+        self.max_buffered_size = max_buffered_size
+        self.fs = fs
+        self.buffers = {}
+        self.buffered_sizes = {}
+        self.buffered_size = 0
+        self.appended_paths = set()
+        self.append_calls = 0
 
     def write(self, path_and_filename, data_str, format='csv'):
-        mssparkutils.fs.append(f"{self.root_destination}/{path_and_filename}", data_str, True) # Set the last parameter as True to create the file if it does not exist
+        if path_and_filename not in self.buffers:
+            self.buffers[path_and_filename] = []
+            self.buffered_sizes[path_and_filename] = 0
+        self.buffers[path_and_filename].append(data_str)
+        self.buffered_sizes[path_and_filename] += len(data_str)
+        self.buffered_size += len(data_str)
+        if self.buffered_sizes[path_and_filename] >= self.flush_size:
+            self._append(path_and_filename)
+        elif self.buffered_size > self.max_buffered_size:
+            self._append(max(self.buffered_sizes, key=self.buffered_sizes.get))
+
+    def _append(self, path_and_filename):
+        data_str = ''.join(self.buffers[path_and_filename])
+        # empty writes are still appended once, so the file gets created (as it would be without buffering)
+        if data_str or path_and_filename not in self.appended_paths:
+            self.fs.append(f"{self.root_destination}/{path_and_filename}", data_str, True) # Set the last parameter as True to create the file if it does not exist
+            self.appended_paths.add(path_and_filename)
+            self.append_calls += 1
+        self.buffered_size -= self.buffered_sizes[path_and_filename]
+        self.buffers[path_and_filename] = []
+        self.buffered_sizes[path_and_filename] = 0
+
+    def flush(self):
+        for path_and_filename in self.buffers:
+            self._append(path_and_filename)
+
+    def close(self):
+        self.flush()
+        self.buffers = {}
+        self.buffered_sizes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 class FileWriter:
-    def __init__(self, root_destination=None):
+    """ Appends data to files under root_destination. Writes are buffered (buffer_size bytes per file) and at most max_open_files files are kept open;
+        when the limit is reached the least recently written file is closed (flushing its buffer) and reopened later if needed.
+        Call close(), or use the writer in a with block, to flush the data that is still buffered.
+        get_stats() reports the amount of data written and the sustained write throughput.
+        Note: this class is also defined in DataGenUtil.py; keep the two copies in sync.
+    """
+    def __init__(self, root_destination=None, buffer_size=1024*1024, max_open_files=64):
         if not root_destination: self.root_destination = ''
         elif not root_destination.endswith('/'): self.root_destination = root_destination + '/'
         else: self.root_destination = root_destination
-        self.writers = {}
+        self.buffer_size = buffer_size
+        self.max_open_files = max_open_files
+        self.writers = collections.OrderedDict()
+        self.chars_written = 0
+        self.files_opened = 0
+        self.write_seconds = 0.0
 
     def write(self, path_and_filename, data_str):
+        start_time = time.perf_counter()
         path_and_filename = self.root_destination + path_and_filename
-        if path_and_filename not in self.writers.keys():
-            if not os.path.exists(os.path.dirname(path_and_filename)):
+        if path_and_filename in self.writers:
+            self.writers.move_to_end(path_and_filename)
+        else:
+            if len(self.writers) >= self.max_open_files:
+                least_recently_used_path, least_recently_used_writer = self.writers.popitem(last=False)
+                least_recently_used_writer.close()
+            if os.path.dirname(path_and_filename) and not os.path.exists(os.path.dirname(path_and_filename)):
                 os.makedirs(os.path.dirname(path_and_filename))
-            self.writers[path_and_filename] = open(path_and_filename, 'a')
-        
-        self.writers[path_and_filename].write(data_str)
\ No newline at end of file
+            self.writers[path_and_filename] = open(path_and_filename, 'a', buffering=self.buffer_size)
+            self.files_opened += 1
+
+        self.writers[path_and_filename].write(data_str)
+        self.chars_written += len(data_str)
+        self.write_seconds += time.perf_counter() - start_time
+
+    def flush(self):
+        start_time = time.perf_counter()
+        for writer in self.writers.values():
+            writer.flush()
+        self.write_seconds += time.perf_counter() - start_time
+
+    def close(self):
+        start_time = time.perf_counter()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = collections.OrderedDict()
+        self.write_seconds += time.perf_counter() - start_time
+
+    def get_stats(self):
+        """ Returns the number of characters written, the number of times a file was opened, the time spent writing (including flushes) and the resulting throughput in MB/s. """
+        mb_per_second = self.chars_written / (1024 * 1024) / self.write_seconds if self.write_seconds else 0.0
+        return {'chars_written': self.chars_written, 'files_opened': self.files_opened, 'write_seconds': self.write_seconds, 'mb_per_second': mb_per_second}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
\ No newline at end of file
@@ -4,3 +4,36 @@ def create_sample_data():
     demo_df.show()
 #create_sample_data()
 
+
+def benchmark_pseudonymize(oea, num_columns=60, num_rows=1000000):
+    """ Compares oea.pseudonymize with the previous approach of chaining a withColumn per column, on a wide df with a mix of hashed, masked and no-op columns. """
+    import time
+    from pyspark.sql import functions as F
+    schema = [[f"col{n}", 'string', ['hash', 'mask', 'no-op', 'hnl'][n % 4]] for n in range(num_columns)]
+    df = spark.range(num_rows).select([F.concat(F.lit(f"v{n}_"), F.col('id').cast('string')).alias(f"col{n}") for n in range(num_columns)])
+
+    def chained_pseudonymize(df, schema):
+        df_pseudo = df_lookup = df
+        for col_name, dtype, op in schema:
+            if op == 'hnl':
+                df_pseudo = df_pseudo.withColumn(col_name, F.sha2(F.concat(F.col(col_name), F.lit(oea.salt)), 256)).withColumnRenamed(col_name, col_name + "_pseudonym")
+                df_lookup = df_lookup.drop(col_name)
+            elif op == 'hash':
+                df_pseudo = df_pseudo.withColumn(col_name, F.sha2(F.concat(F.col(col_name), F.lit(oea.salt)), 256)).withColumnRenamed(col_name, col_name + "_pseudonym")
+                df_lookup = df_lookup.withColumn(col_name + "_pseudonym", F.sha2(F.concat(F.col(col_name), F.lit(oea.salt)), 256))
+            elif op == 'mask':
+                df_pseudo = df_pseudo.withColumn(col_name, F.lit('*'))
+            elif op == 'no-op':
+                df_lookup = df_lookup.drop(col_name)
+        return (oea.fix_column_names(df_pseudo), oea.fix_column_names(df_lookup))
+
+    for name, pseudonymize in [('chained withColumn', chained_pseudonymize), ('single select', oea.pseudonymize)]:
+        start = time.time()
+        df_pseudo, df_lookup = pseudonymize(df, schema)
+        df_pseudo.schema, df_lookup.schema # forces the analysis of both plans
+        analysis_time = time.time() - start
+        start = time.time()
+        df_pseudo.write.format('noop').mode('overwrite').save()
+        df_lookup.write.format('noop').mode('overwrite').save()
+        print(f"{name}: plan analysis {analysis_time:.2f}s, execution {time.time() - start:.2f}s")
+#benchmark_pseudonymize(oea)
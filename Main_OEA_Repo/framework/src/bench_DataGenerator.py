@@ -0,0 +1,29 @@
+""" Times M365DataGenerator school creation for increasing school sizes, to check that the cost per student stays flat as schools grow.
+    Usage: python bench_DataGenerator.py [students_per_school ...]   (defaults to 100 1000 10000 100000)
+    Daily section attendance is only generated as it's written (see M365DataGenerator.iter_attendance), so this times the roster,
+    membership and marks builders that used to grow quadratically with the number of students.
+"""
+import sys
+import time
+import random
+import M365DataGenerator
+
+def time_school(students_per_school):
+    random.seed(1)
+    dg = M365DataGenerator.M365DataGenerator(students_per_school=students_per_school, faker_pool_size=1000)
+    start = time.perf_counter()
+    school = dg.create_school(1)
+    create_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    m365_data = dg.format_m365_data(school)
+    format_seconds = time.perf_counter() - start
+    rows = sum(len(value) for value in m365_data.values() if isinstance(value, list)) + len(school['_section_marks'])
+    return create_seconds, format_seconds, rows
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000, 100000]
+    print(f"{'students':>10} {'create_school(s)':>17} {'format(s)':>10} {'rows':>10} {'us/student':>11}")
+    for students_per_school in sizes:
+        create_seconds, format_seconds, rows = time_school(students_per_school)
+        per_student = (create_seconds + format_seconds) / students_per_school * 1000000
+        print(f"{students_per_school:>10} {create_seconds:>17.2f} {format_seconds:>10.2f} {rows:>10} {per_student:>11.0f}")
@@ -1,5 +1,11 @@
 import os
+import io
+import csv
+import json
 import shutil
+import random
+import pandas as pd
+import pytest
 import DataGenUtil
 import ContosoDataGenerator
 import M365DataGenerator
@@ -13,23 +19,159 @@ os.makedirs(destination)
 
 def test_ContosoDataGenerator():
     dg = ContosoDataGenerator.ContosoDataGenerator()
-    writer = DataGenUtil.FileWriter(destination)
-    dg.generate_data(2, writer)
+    with DataGenUtil.FileWriter(destination) as writer:
+        dg.generate_data(2, writer)
     
 def test_M365DataGenerator():
     dg = M365DataGenerator.M365DataGenerator()
-    writer = DataGenUtil.FileWriter(destination)
-    dg.generate_data(1, writer)
+    with DataGenUtil.FileWriter(destination) as writer:
+        dg.generate_data(1, writer)
     
 def test_MSInsightsDataGenerator():
     dg = MSInsightsDataGenerator.MSInsightsDataGenerator()
-    writer = DataGenUtil.FileWriter(destination)
-    dg.generate_data(2, writer)
+    with DataGenUtil.FileWriter(destination) as writer:
+        dg.generate_data(2, writer)
 
 def test_EdFiDataGenerator():
     dg = EdFiDataGenerator.EdFiDataGenerator()
-    writer = DataGenUtil.FileWriter(destination)
-    dg.generate_data(2, writer)
+    with DataGenUtil.FileWriter(destination) as writer:
+        dg.generate_data(2, writer)
+
+class ListWriter:
+    """ Collects everything passed to write() so tests can inspect what a generator or serializer emitted. """
+    def __init__(self):
+        self.writes = []
+
+    def write(self, path_and_filename, data_str):
+        self.writes.append((path_and_filename, data_str))
+
+def test_write_rows_as_csv():
+    writer = ListWriter()
+    rows = ({'id': n, 'name': f'Smith, "Jr" {n}', '_internal': 'x'} for n in range(1000))
+    row_count = DataGenUtil.write_rows_as_csv(rows, writer, 'test/rows.csv', chunk_size=1024)
+    assert row_count == 1000
+    assert len(writer.writes) > 1
+    assert all(len(data_str) < 1024 + 100 for path, data_str in writer.writes)
+    csv_str = ''.join([data_str for path, data_str in writer.writes])
+    assert csv_str.startswith('id,name\n0,"Smith, ""Jr"" 0"\n')
+    assert len(list(csv.reader(io.StringIO(csv_str)))) == 1001
+
+def test_ContosoDataGenerator_streams_daily_records():
+    dg = ContosoDataGenerator.ContosoDataGenerator(students_per_school=3)
+    school_data = dg.create_school(0, include_daily_records=False)
+    random.seed(1)
+    attendance, class_attendance, incidents = dg.create_daily_records(0, school_data)
+    random.seed(1)
+    writer = ListWriter()
+    dg.write_daily_records(0, school_data, writer)
+    written = {}
+    for path, data_str in writer.writes:
+        written[path] = written.get(path, '') + data_str
+    assert written['contoso_sis/Attendance.csv'] == DataGenUtil.list_of_dict_to_csv(attendance)
+    assert written['contoso_sis/ClassAttendance.csv'] == DataGenUtil.list_of_dict_to_csv(class_attendance)
+
+def test_vectorized_attendance():
+    dg = ContosoDataGenerator.ContosoDataGenerator(students_per_school=20, vectorized=True)
+    school_data = dg.create_school(0)
+    assert school_data['Attendance'][0].keys() == dg.create_daily_attendance_record(0, school_data['Students'][0], pd.Timestamp('2021-08-15')).keys()
+    assert len(school_data['Attendance']) == len(school_data['ClassAttendance']) == 20 * 269
+    unexcused_rate = sum([record['UnexcusedAllDay'] for record in school_data['Attendance']]) / len(school_data['Attendance'])
+    assert 0.15 < unexcused_rate < 0.25
+
+    dg = M365DataGenerator.M365DataGenerator(students_per_school=20, vectorized=True)
+    dg.numpy_rng = DataGenUtil.create_numpy_rng()
+    attendance = dg.create_section_attendance('sch0', 'st1', '2021', 'sec1', '9/1/2019', '12/22/2019')
+    assert len(attendance) == 113
+    assert list(attendance[0].values())[:8] == ['att_st1', 'st1', '2021', 'sch0', '01/09/2019', 'No', 1, 'sec1']
+    assert attendance[0].keys() == dg.create_attendance_row('sch0', 'st1', '2021', 'sec1', '01/09/2019', 'P', 1, 'Present').keys()
+
+def test_parallel_generation_matches_serial():
+    for generator_class in [ContosoDataGenerator.ContosoDataGenerator, M365DataGenerator.M365DataGenerator]:
+        serial_writer = DataGenUtil.BufferWriter()
+        generator_class(students_per_school=5).generate_data(3, serial_writer, seed=42)
+        parallel_writer = DataGenUtil.BufferWriter()
+        generator_class(students_per_school=5).generate_data(3, parallel_writer, seed=42, processes=2)
+        assert serial_writer.getvalues() == parallel_writer.getvalues()
+
+def test_ParquetWriter():
+    pq = pytest.importorskip('pyarrow.parquet')
+    schemas = {'Attendance': [['SchoolID', 'integer', 'no-op'], ['AttendanceDate', 'timestamp', 'no-op'], ['StudentID', 'integer', 'hash'],
+                              ['NumofPossiblePeriods', 'short', 'no-op'], ['NumofTardies', 'short', 'no-op'], ['NumofUnexcusedAbsent', 'short', 'no-op'],
+                              ['NumofExcusedAbsent', 'short', 'no-op'], ['UnexcusedAllDay', 'boolean', 'no-op'], ['ExcusedAllDay', 'boolean', 'no-op'],
+                              ['Cumulative GPA', 'double', 'no-op']]}
+    writer = DataGenUtil.ParquetWriter(destination + '/parquet', schemas, row_group_size=1000)
+    ContosoDataGenerator.ContosoDataGenerator(students_per_school=5).generate_data(2, writer)
+    writer.close()
+    table = pq.read_table(destination + '/parquet/contoso_sis/Attendance.parquet')
+    assert table.num_rows == 2 * 5 * 269
+    assert str(table.schema.field('AttendanceDate').type) == 'timestamp[us]'
+    assert str(table.schema.field('NumofTardies').type) == 'int16'
+    assert pq.read_table(destination + '/parquet/contoso_sis/Students.parquet').num_rows == 10
+
+def test_ParquetWriter_M365():
+    pq = pytest.importorskip('pyarrow.parquet')
+    schemas = {'Person': [['Id', 'string', 'hash'], ['FirstName', 'string', 'mask'], ['MiddleName', 'string', 'mask'], ['LastName', 'string', 'mask'],
+                          ['GenerationCode', 'string', 'no-op'], ['Prefix', 'string', 'no-op'], ['EnabledUser', 'string', 'no-op'], ['ExternalId', 'string', 'hash'],
+                          ['CreateDate', 'timestamp', 'no-op'], ['LastModifiedDate', 'timestamp', 'no-op'], ['IsActive', 'boolean', 'no-op'], ['SourceSystemId', 'string', 'no-op']],
+               'studentsectionmark': [['id', 'string', 'no-op'], ['student_id', 'string', 'hash'], ['section_id', 'string', 'no-op'], ['school_year', 'string', 'no-op'],
+                                      ['term_id', 'string', 'no-op'], ['numeric_grade_earned', 'short', 'no-op'], ['alpha_grade_earned', 'string', 'no-op'],
+                                      ['is_final_grade', 'string', 'no-op'], ['credits_attempted', 'short', 'no-op'], ['credits_earned', 'short', 'no-op'],
+                                      ['grad_credit_type', 'string', 'no-op']]}
+    local_fs = DataGenUtil.LocalFs()
+    writer = DataGenUtil.ParquetWriter(destination + '/parquet_m365', schemas, entity_names=M365DataGenerator.MODULE_ENTITY_NAMES, fs=local_fs)
+    M365DataGenerator.M365DataGenerator(students_per_school=5).generate_data(2, writer, seed=1, processes=2)
+    writer.close()
+    person = pq.read_table(destination + '/parquet_m365/m365/Person.parquet')
+    assert person.num_rows == 2 * (5 + 1)
+    assert str(person.schema.field('CreateDate').type) == 'timestamp[us]'
+    marks = pq.read_table(destination + '/parquet_m365/contoso_sis/section_marks.parquet')
+    assert str(marks.schema.field('numeric_grade_earned').type) == 'int16'
+    assert pq.read_table(destination + '/parquet_m365/contoso_sis/attendance.parquet').num_rows > 0
+
+def test_FileWriter_limits_open_files():
+    with DataGenUtil.FileWriter(destination + '/lru', buffer_size=16, max_open_files=2) as writer:
+        for n in range(100):
+            writer.write(f"file{n % 5}.csv", f"{n}\n")
+            assert len(writer.writers) <= 2
+    assert writer.get_stats()['chars_written'] == sum([len(f"{n}\n") for n in range(100)])
+    assert open(destination + '/lru/file3.csv').read() == ''.join([f"{n}\n" for n in range(3, 100, 5)])
+
+def test_DataLakeWriter_batches_appends():
+    local_fs = DataGenUtil.LocalFs()
+    with DataGenUtil.DataLakeWriter(destination + '/lake', flush_size=64*1024, fs=local_fs) as writer:
+        M365DataGenerator.M365DataGenerator(students_per_school=10).generate_data(2, writer, seed=3)
+    with DataGenUtil.FileWriter(destination + '/lake_expected') as expected_writer:
+        M365DataGenerator.M365DataGenerator(students_per_school=10).generate_data(2, expected_writer, seed=3)
+    activity = open(destination + '/lake/m365/Activity0p2.csv').read()
+    assert activity == open(destination + '/lake_expected/m365/Activity0p2.csv').read()
+    assert local_fs.append_calls < 50 < activity.count('\n')
+
+def test_DataLakeWriter_is_flushed_by_generate_data():
+    local_fs = DataGenUtil.LocalFs()
+    writer = DataGenUtil.DataLakeWriter(destination + '/lake_unclosed', fs=local_fs)
+    M365DataGenerator.M365DataGenerator(students_per_school=10).generate_data(1, writer, seed=3)
+    assert writer.buffered_size == 0
+    assert open(destination + '/lake_unclosed/m365/Org.csv').read().count('\n') == 1
+
+def test_FakerPool_is_deterministic():
+    outputs = []
+    for processes in [1, 1, 2]:
+        writer = DataGenUtil.BufferWriter()
+        EdFiDataGenerator.EdFiDataGenerator(number_students_per_school=20, faker_pool_size=100).generate_data(2, writer, seed=5, processes=processes)
+        outputs.append(writer.getvalues())
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert len(set([student['Id'] for student in json.loads(outputs[0]['EdFi/Student.json'])])) == 40
+
+def test_SectionSeatAllocator():
+    seats = DataGenUtil.SectionSeatAllocator()
+    seats.add_section('sec1', 1)
+    seats.add_section('sec2', 2)
+    seats.add_section('sec3', 2)
+    assert seats.allocate(2) == ['sec1', 'sec2']
+    assert seats.allocate(2) == ['sec2', 'sec3']
+    assert seats.allocate(2) == ['sec3']
+    assert seats.allocate(2) == []
+    assert seats.available_seats() == 0
 
 #test_ContosoDataGenerator()
 #test_M365DataGenerator()